@@ -0,0 +1,126 @@
+import argparse
+import json
+import os
+from mainCodeDLAndSparkAndPipline import (
+    DEFAULT_BUNDLE_DIR,
+    SCORE_COLUMNS,
+    broadcast_bundle,
+    ensure_nltk_resources,
+    executor_classifier,
+    lazy_import,
+    score_schema_fields,
+    score_text_series,
+)
+
+# Output partition column; a row's bucket depends only on its text, so it is the same on every run
+BUCKET_COLUMN = 'backfill_bucket'
+
+def create_spark_session(args):
+    return lazy_import('pyspark.sql').SparkSession.builder \
+        .appName("RedditSentimentBackfill") \
+        .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+        .config("spark.sql.execution.arrow.maxRecordsPerBatch", str(args.batch_size)) \
+        .config("spark.sql.sources.partitionOverwriteMode", "dynamic") \
+        .getOrCreate()
+
+def read_input(spark, paths, input_format=None):
+    """CSV (with a header row) or Parquet input; the format defaults to the first path's extension"""
+    input_format = input_format or ('csv' if paths[0].lower().endswith('.csv') else 'parquet')
+    if input_format == 'csv':
+        # multiLine keeps Reddit comments with embedded newlines in one row
+        return spark.read.csv(paths, header=True, inferSchema=True, multiLine=True, escape='"')
+    return spark.read.parquet(*paths)
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_state(state_path, state):
+    # Replace atomically, so an interrupted run never leaves a truncated state file
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+def run(args):
+    ensure_nltk_resources(download=args.download_nltk)
+    functions = lazy_import('pyspark.sql.functions')
+    types = lazy_import('pyspark.sql.types')
+    print("Initializing Spark session...")
+    spark = create_spark_session(args)
+    df = read_input(spark, args.input, args.format)
+    if args.text_column not in df.columns:
+        raise ValueError(f"Input has no {args.text_column!r} column (columns: {', '.join(df.columns)})")
+    clashing = [column for column in SCORE_COLUMNS + (BUCKET_COLUMN,) if column in df.columns]
+    if clashing:
+        raise ValueError(f"Input already has output column(s) {', '.join(clashing)}")
+    df = df.withColumn(BUCKET_COLUMN, functions.expr(f"pmod(xxhash64(`{args.text_column}`), {args.buckets})").cast('int'))
+
+    # Executors import the pipeline module for the bundle loader and scorer
+    spark.sparkContext.addPyFile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mainCodeDLAndSparkAndPipline.py'))
+    bundle_broadcast = broadcast_bundle(spark.sparkContext, args.bundle_dir, args.bundle_version, backend=args.backend)
+    bundle_version = bundle_broadcast.value['version']
+
+    state_path = args.state_file or os.path.join(args.output, '_backfill_state.json')
+    state = None if args.restart else load_state(state_path)
+    run_settings = {'bundle_version': bundle_version, 'buckets': args.buckets, 'text_column': args.text_column, 'input': args.input}
+    if state is not None and state['settings'] != run_settings:
+        raise ValueError(
+            f"{state_path} belongs to a run with different settings ({state['settings']}); "
+            "use --restart to score everything again, or a new --output"
+        )
+    if state is None:
+        state = {'settings': run_settings, 'done': []}
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    save_state(state_path, state)
+
+    text_column, backend, cascade = args.text_column, args.backend, args.cascade
+    pd = lazy_import('pandas')
+
+    def score_batches(batches):
+        # One classifier per executor Python worker, then one forward pass per Arrow batch
+        classifier = executor_classifier(bundle_broadcast, backend, cascade)
+        for batch in batches:
+            scores = score_text_series(batch[text_column], classifier)
+            scores.index = batch.index
+            yield pd.concat([batch, scores], axis=1)
+
+    schema = types.StructType(df.schema.fields + score_schema_fields())
+    done = set(state['done'])
+    remaining = [bucket for bucket in range(args.buckets) if bucket not in done]
+    print(f"Scoring {len(remaining)} of {args.buckets} buckets with bundle {bundle_version} into {args.output}...")
+    for start in range(0, len(remaining), args.buckets_per_job):
+        group = remaining[start:start + args.buckets_per_job]
+        # Dynamic overwrite replaces only these buckets' directories, including partial output of a crashed run
+        df.where(functions.col(BUCKET_COLUMN).isin(group)) \
+            .repartition(len(group), BUCKET_COLUMN) \
+            .mapInPandas(score_batches, schema) \
+            .write.mode('overwrite') \
+            .partitionBy(BUCKET_COLUMN) \
+            .parquet(args.output)
+        state['done'] = sorted(state['done'] + group)
+        save_state(state_path, state)
+        print(f"{len(state['done'])}/{args.buckets} buckets done")
+    bundle_broadcast.unpersist()
+    spark.stop()
+    print(f"Backfill complete: {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score CSV/Parquet corpora with a saved model bundle into Parquet, restartable per bucket")
+    parser.add_argument('input', nargs='+', help="input files or directories, e.g. Reddit_Data.csv")
+    parser.add_argument('--output', required=True, help="Parquet output directory, partitioned by backfill_bucket")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default=None, help="default: csv for *.csv inputs, otherwise parquet")
+    parser.add_argument('--text-column', default='Text')
+    parser.add_argument('--bundle-dir', default=DEFAULT_BUNDLE_DIR)
+    parser.add_argument('--bundle-version', default=None, help="default: the bundle's LATEST version")
+    parser.add_argument('--backend', default='numpy', choices=['numpy', 'tflite', 'keras'], help="numpy needs no TensorFlow on the executors")
+    parser.add_argument('--cascade', action='store_true', help="answer confident texts with the bundle's first-stage classifier, if it has one")
+    parser.add_argument('--batch-size', type=int, default=4096, help="rows per Arrow batch, i.e. per forward pass")
+    parser.add_argument('--buckets', type=int, default=64, help="restart granularity: completed buckets are skipped on rerun")
+    parser.add_argument('--buckets-per-job', type=int, default=8, help="buckets scored per Spark job (each job rescans the input)")
+    parser.add_argument('--state-file', default=None, help="progress file on the driver; default: <output>/_backfill_state.json")
+    parser.add_argument('--restart', action='store_true', help="ignore recorded progress and score every bucket again")
+    parser.add_argument('--download-nltk', action='store_true')
+    run(parser.parse_args())
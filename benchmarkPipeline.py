@@ -0,0 +1,360 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from mainCodeDLAndSparkAndPipline import (
+    CHAT_WORDS,
+    BulkMongoWriter,
+    RedditSentimentClassifier,
+    StreamingMetrics,
+    StreamingPipeline,
+    WordIndexTokenizer,
+    clean_texts_parallel,
+    encode_texts,
+    ensure_nltk_resources,
+    lazy_import,
+    predict_bucketed,
+    process_messages,
+)
+
+# Bump when the corpus generator or a suite's measurement changes, so old results are not diffed against new ones
+BENCHMARK_FORMAT_VERSION = 1
+SUITES = ('clean', 'tokenizer', 'predict', 'e2e')
+CLEAN_STEPS = (
+    'remove_html_tags',
+    'remove_urls',
+    'remove_punctuation',
+    'replace_chat_words',
+    'remove_stopwords',
+    'remove_emojis',
+    'lemmatize_text',
+    'to_lower_case',
+)
+PREDICT_BATCH_SIZES = (1, 8, 32, 128, 512)
+CORPUS_WORDS = [
+    'modi', 'election', 'vote', 'government', 'india', 'people', 'great', 'terrible', 'love', 'hate',
+    'running', 'studies', 'better', 'movies', 'service', 'product', 'amazing', 'worst', 'happy', 'sad',
+    'really', 'never', 'always', 'congress', 'policy', 'economy', 'jobs', 'rally', 'speech', 'news',
+    'the', 'is', 'and', 'not', 'this', 'that', 'was', 'they', 'will', 'with',
+]
+CORPUS_EXTRAS = [
+    'https://www.reddit.com/r/india', 'http://t.co/x1y2z3', 'www.example.com/page',
+    '<b>', '</b>', '<p>', '</p>', '#bestpurchase', '#badservice', '@someone',
+    '😁', '😊', '😡👎', '!!!', '...', "it's", "don't", 'U.S.', '(really)', '100%',
+]
+
+def make_corpus(size, seed=42):
+    """Fixed synthetic Reddit/Twitter-like corpus: common words, a long tail, chat words, URLs, HTML and emojis"""
+    rng = random.Random(seed)
+    chat_words = sorted(CHAT_WORDS)
+    texts = []
+    for _ in range(size):
+        words = []
+        for _ in range(rng.choice((3, 8, 15, 30, 60, 120))):
+            roll = rng.random()
+            if roll < 0.55:
+                word = rng.choice(CORPUS_WORDS)
+            elif roll < 0.8:
+                # Zipf-like tail so the vocabulary grows with the corpus like real posts do
+                word = f'topic{int(rng.paretovariate(1.0)) % 100000}'
+            elif roll < 0.9:
+                word = rng.choice(chat_words)
+            else:
+                word = rng.choice(CORPUS_EXTRAS)
+            if rng.random() < 0.1:
+                word = word.capitalize()
+            words.append(word)
+        texts.append(' '.join(words))
+    return texts
+
+def summarize_timings(timings_ms, items_per_call=1):
+    """Latency percentiles of repeated calls plus the implied throughput"""
+    timings_ms = np.asarray(timings_ms)
+    mean_ms = float(timings_ms.mean())
+    return {
+        'calls': len(timings_ms),
+        'mean_ms': round(mean_ms, 4),
+        'p50_ms': round(float(np.percentile(timings_ms, 50)), 4),
+        'p95_ms': round(float(np.percentile(timings_ms, 95)), 4),
+        'min_ms': round(float(timings_ms.min()), 4),
+        'items_per_s': round(items_per_call * 1000.0 / mean_ms, 1) if mean_ms else None,
+    }
+
+def time_calls(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    timings_ms = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings_ms.append((time.perf_counter() - started) * 1000)
+    return timings_ms
+
+def time_once(fn):
+    started = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - started) * 1000
+
+def benchmark_clean(classifier, corpus, num_workers):
+    """Per-step cost of the cleaning chain, each step fed the previous step's output"""
+    results = {'steps': {}}
+    texts = list(corpus)
+    for step in CLEAN_STEPS:
+        method = getattr(classifier, step)
+        texts, elapsed_ms = time_once(lambda: [method(text) for text in texts])
+        results['steps'][step] = {
+            'total_ms': round(elapsed_ms, 2),
+            'us_per_text': round(elapsed_ms * 1000 / len(corpus), 3),
+        }
+    for name, fn in (('clean_text_stepwise', classifier.clean_text_stepwise), ('clean_text', classifier.clean_text)):
+        _, elapsed_ms = time_once(lambda: [fn(text) for text in corpus])
+        results[name] = {
+            'total_ms': round(elapsed_ms, 2),
+            'texts_per_s': round(len(corpus) * 1000.0 / elapsed_ms, 1),
+        }
+    _, elapsed_ms = time_once(lambda: clean_texts_parallel(corpus, num_workers=num_workers))
+    results['clean_texts_parallel'] = {
+        'workers': num_workers,
+        'total_ms': round(elapsed_ms, 2),
+        'texts_per_s': round(len(corpus) * 1000.0 / elapsed_ms, 1),
+    }
+    return results
+
+def benchmark_tokenizer(cleaned, max_words, max_len, num_workers, repeat):
+    """Vocabulary fit and batch encode throughput, against keras Tokenizer when TensorFlow is installed"""
+    results = {}
+    tokenizer = WordIndexTokenizer(num_words=max_words, oov_token='<OOV>')
+    for workers in sorted({1, num_workers}):
+        timings = time_calls(lambda: tokenizer.fit_on_texts(cleaned, num_workers=workers), repeat, warmup=0)
+        results[f'fit_workers_{workers}'] = summarize_timings(timings, len(cleaned))
+    results['vocabulary_size'] = len(tokenizer.word_index)
+    results['encode'] = summarize_timings(time_calls(lambda: tokenizer.encode(cleaned, max_len), repeat), len(cleaned))
+    try:
+        text = lazy_import('tensorflow.keras.preprocessing.text')
+        pad_sequences = lazy_import('tensorflow.keras.preprocessing.sequence').pad_sequences
+    except ImportError:
+        return results
+    keras_tokenizer = text.Tokenizer(num_words=max_words, oov_token='<OOV>')
+    results['keras_fit'] = summarize_timings(time_calls(lambda: keras_tokenizer.fit_on_texts(cleaned), 1, warmup=0), len(cleaned))
+    results['keras_encode'] = summarize_timings(
+        time_calls(lambda: pad_sequences(keras_tokenizer.texts_to_sequences(cleaned), maxlen=max_len, padding='post', truncating='post'), repeat),
+        len(cleaned)
+    )
+    return results
+
+def benchmark_predict(classifier, padded_sequences, batch_sizes, backend):
+    """Forward-pass latency per batch size for one inference backend"""
+    results = {}
+    model = classifier.model
+    for batch_size in batch_sizes:
+        rows = np.resize(np.arange(len(padded_sequences)), batch_size)
+        batch = padded_sequences[rows]
+        repeat = max(5, min(50, 2000 // batch_size))
+        entry = {
+            'predict_on_batch': summarize_timings(time_calls(lambda: model.predict_on_batch(batch), repeat, warmup=2), batch_size),
+            'predict_bucketed': summarize_timings(time_calls(lambda: predict_bucketed(model, batch), repeat, warmup=2), batch_size),
+        }
+        if backend == 'keras':
+            entry['predict'] = summarize_timings(
+                time_calls(lambda: model.predict(batch, batch_size=batch_size, verbose=0), repeat, warmup=2), batch_size
+            )
+        results[str(batch_size)] = entry
+    return results
+
+class FakeRecord:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class FakeKafkaConsumer:
+    """In-process stand-in for KafkaConsumer.poll that replays a fixed list of messages once"""
+    def __init__(self, messages, on_exhausted=None):
+        self.records = [FakeRecord(message) for message in messages]
+        self.position = 0
+        self.on_exhausted = on_exhausted
+
+    def poll(self, timeout_ms=0, max_records=500):
+        if self.position >= len(self.records):
+            if self.on_exhausted is not None:
+                self.on_exhausted()
+            time.sleep(min(timeout_ms, 10) / 1000.0)
+            return {}
+        records = self.records[self.position:self.position + max_records]
+        self.position += len(records)
+        return {('benchmark', 0): records}
+
+    def close(self):
+        pass
+
+class FakeMongoCollection:
+    """In-process stand-in for a pymongo collection, with an optional per-call round trip"""
+    def __init__(self, latency_ms=0):
+        self.latency_ms = latency_ms
+        self.inserted = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def insert_many(self, documents, ordered=True):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        with self._lock:
+            self.inserted += len(documents)
+            self.calls += 1
+
+def benchmark_end_to_end(classifier, corpus, mode, mongo_latency_ms, config):
+    """Throughput of the Kafka-to-Mongo consumer over fake Kafka and Mongo"""
+    collection = FakeMongoCollection(latency_ms=mongo_latency_ms)
+    metrics = StreamingMetrics()
+    writer = BulkMongoWriter(collection, batch_size=config['mongo_batch_size'], flush_interval_ms=config['mongo_flush_interval_ms'], metrics=metrics)
+    consumer = FakeKafkaConsumer(corpus)
+    started = time.perf_counter()
+    # Keep the consumers' progress prints out of the report output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if mode == 'pipelined':
+            pipeline = StreamingPipeline(
+                consumer, writer, classifier,
+                preprocess_workers=config['preprocess_workers'],
+                queue_size=config['pipeline_queue_size'],
+                max_batch_size=config['max_batch_size'],
+                max_wait_ms=config['max_wait_ms'],
+                target_latency_ms=config['target_latency_ms'],
+                metrics=metrics
+            )
+            consumer.on_exhausted = pipeline.stop
+            pipeline.run()
+        else:
+            stop_event = threading.Event()
+            consumer.on_exhausted = stop_event.set
+            process_messages(
+                consumer, writer, classifier,
+                max_batch_size=config['max_batch_size'],
+                max_wait_ms=config['max_wait_ms'],
+                target_latency_ms=config['target_latency_ms'],
+                stop_event=stop_event,
+                metrics=metrics
+            )
+        writer.close()
+    elapsed_s = time.perf_counter() - started
+    return {
+        'messages': len(corpus),
+        'written': collection.inserted,
+        'mongo_insert_calls': collection.calls,
+        'mongo_latency_ms': mongo_latency_ms,
+        'seconds': round(elapsed_s, 3),
+        'messages_per_s': round(len(corpus) / elapsed_s, 1),
+        'mean_batch_size': metrics.snapshot()['mean_batch_size'],
+        'stages': metrics.snapshot()['stages'],
+    }
+
+def load_benchmark_classifier(args, corpus, backend):
+    """Classifier from a saved bundle, or an untrained one with production shapes when no bundle is given"""
+    if args.bundle_dir:
+        return RedditSentimentClassifier.load_bundle(args.bundle_dir, backend=backend)
+    if not hasattr(args, '_untrained_bundle'):
+        classifier = RedditSentimentClassifier(max_words=args.max_words, max_len=args.max_len, embedding_dim=args.embedding_dim)
+        classifier.tokenizer.fit_on_texts([classifier.clean_text(text) for text in corpus], num_workers=1)
+        classifier.build_model()
+        classifier.model.build((None, args.max_len))
+        # Random weights time the same as trained ones; going through a bundle exercises the serving loader
+        args._untrained_bundle = tempfile.mkdtemp(prefix='sentanaly-benchmark-')
+        classifier.save_bundle(args._untrained_bundle, version='benchmark', tflite_quantization='dynamic' if 'tflite' in args.backends else None)
+    return RedditSentimentClassifier.load_bundle(args._untrained_bundle, backend=backend)
+
+def environment_info(args):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {'numpy': np.__version__}
+    for name in ('tensorflow', 'nltk', 'emoji'):
+        module = sys.modules.get(name)
+        versions[name] = getattr(module, '__version__', None) if module else None
+    return {
+        'format_version': BENCHMARK_FORMAT_VERSION,
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions,
+        'args': {key: value for key, value in vars(args).items() if not key.startswith('_')},
+        'model': 'bundle' if args.bundle_dir else 'untrained (random weights)',
+    }
+
+def run_benchmarks(args):
+    ensure_nltk_resources(download=args.download_nltk)
+    corpus = make_corpus(args.corpus_size, seed=args.seed)
+    suites = args.suites
+    results = {}
+    num_workers = args.workers or os.cpu_count() or 1
+    classifier = RedditSentimentClassifier(max_words=args.max_words, max_len=args.max_len, embedding_dim=args.embedding_dim)
+    if 'clean' in suites:
+        print("Benchmarking cleaning steps...")
+        results['clean'] = benchmark_clean(classifier, corpus, num_workers)
+    cleaned = [classifier.clean_text(text) for text in corpus]
+    if 'tokenizer' in suites:
+        print("Benchmarking tokenizer...")
+        results['tokenizer'] = benchmark_tokenizer(cleaned, args.max_words, args.max_len, num_workers, args.repeat)
+    if 'predict' in suites:
+        results['predict'] = {}
+        for backend in args.backends:
+            print(f"Benchmarking {backend} inference...")
+            backend_classifier = load_benchmark_classifier(args, corpus, backend)
+            padded_sequences = encode_texts(cleaned, backend_classifier)
+            results['predict'][backend] = benchmark_predict(backend_classifier, padded_sequences, args.batch_sizes, backend)
+    if 'e2e' in suites:
+        results['end_to_end'] = {}
+        backend_classifier = load_benchmark_classifier(args, corpus, args.backends[0])
+        config = {
+            'mongo_batch_size': 500,
+            'mongo_flush_interval_ms': 1000,
+            'max_batch_size': 512,
+            'max_wait_ms': 100,
+            'target_latency_ms': 250,
+            'preprocess_workers': 2,
+            'pipeline_queue_size': 4,
+        }
+        messages = make_corpus(args.e2e_messages, seed=args.seed + 1)
+        for mode in ('serial', 'pipelined'):
+            print(f"Benchmarking end-to-end {mode} consumer ({args.backends[0]} backend)...")
+            results['end_to_end'][mode] = benchmark_end_to_end(backend_classifier, messages, mode, args.mongo_latency_ms, config)
+    return {'environment': environment_info(args), 'results': results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark preprocessing, tokenization, inference and end-to-end throughput")
+    parser.add_argument('--suites', default=','.join(SUITES), type=lambda value: value.split(','), help=f"comma-separated subset of {','.join(SUITES)}")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--corpus-size', type=int, default=5000)
+    parser.add_argument('--e2e-messages', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch-sizes', default=PREDICT_BATCH_SIZES, type=lambda value: [int(size) for size in value.split(',')])
+    parser.add_argument('--backends', default=['keras'], type=lambda value: value.split(','), help="comma-separated keras,numpy,tflite; e2e uses the first")
+    parser.add_argument('--bundle-dir', default=None, help="benchmark a trained bundle instead of an untrained model")
+    parser.add_argument('--max-words', type=int, default=50000)
+    parser.add_argument('--max-len', type=int, default=200)
+    parser.add_argument('--embedding-dim', type=int, default=200)
+    parser.add_argument('--mongo-latency-ms', type=float, default=2.0)
+    parser.add_argument('--download-nltk', action='store_true')
+    args = parser.parse_args()
+    unknown_suites = set(args.suites) - set(SUITES)
+    if unknown_suites:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown_suites))}")
+    report = run_benchmarks(args)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Wrote benchmark results to {args.output}")
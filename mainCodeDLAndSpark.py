@@ -16,16 +16,10 @@ from bs4 import BeautifulSoup
 import emoji
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
-import nltk
 import warnings
+import sys
+from mainCodeDLAndSparkAndPipline import ensure_nltk_resources, prepare_data_spark
 
-try:
-    nltk.download('stopwords', quiet=True)
-    nltk.download('wordnet', quiet=True)
-    nltk.download('omw-1.4', quiet=True)
-    print("NLTK resources downloaded successfully")
-except Exception as e:
-    print(f"Error downloading NLTK resources: {e}")
 
 class RedditSentimentClassifier:
     def __init__(self, max_words=50000, max_len=200, embedding_dim=200):
@@ -222,6 +216,8 @@ def remove_nan_duplicates(df):
     df = df.dropna() 
     return df
 def main():
+    # Corpora come from the local NLTK cache; pass --download-nltk to fetch missing ones
+    ensure_nltk_resources(download='--download-nltk' in sys.argv, required=True)
     print("Initializing Spark session...")
     spark = SparkSession.builder \
         .appName("RedditSentimentAnalysis") \
@@ -240,7 +236,8 @@ def main():
         embedding_dim=200
     )
     
-    X, y = classifier.prepare_data(df)
+    # Clean and encode on the executors instead of pulling the corpus onto the driver
+    X, y = prepare_data_spark(classifier, df)
     
     print("Splitting data...")
     X_train, X_temp, y_train, y_temp = train_test_split(X, y, test_size=0.3, random_state=42)
@@ -278,12 +275,13 @@ def main():
     sequences = classifier.tokenizer.texts_to_sequences(preprocessed_data)
     padded_sequences = pad_sequences(sequences, maxlen=classifier.max_len, padding='post', truncating='post')
     
+    # One forward pass over all samples instead of a predict call per sample
+    predicted_labels = np.argmax(classifier.model.predict(padded_sequences), axis=1)
+    
     # Print the results
-    for i, text in zip(padded_sequences, preprocessed_data):
+    for predicted_label, text in zip(predicted_labels, preprocessed_data):
         print(f"Original Text: {text}")
-        prediction = classifier.model.predict(np.array([i]))   
-        predicted_label = np.argmax(prediction, axis=1)
-        print(f"Predicted Label: {predicted_label[0]} ({'Positive' if predicted_label == 2 else 'Negative' if predicted_label == 0 else 'Neutral'})\n")
+        print(f"Predicted Label: {predicted_label} ({'Positive' if predicted_label == 2 else 'Negative' if predicted_label == 0 else 'Neutral'})\n")
 
     # Stop Spark session
     spark.stop()
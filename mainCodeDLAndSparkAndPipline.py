@@ -1,47 +1,259 @@
+import argparse
+import atexit
+import bisect
+import contextlib
 import datetime
-import numpy as np
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf
-from pyspark.sql.types import StringType
-from tensorflow.keras.preprocessing.text import Tokenizer
-from tensorflow.keras.preprocessing.sequence import pad_sequences
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Embedding, LSTM, Dense, Dropout, BatchNormalization
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
-from tensorflow.keras.optimizers import Adam
-from sklearn.model_selection import train_test_split
-from sklearn.utils.class_weight import compute_class_weight
-from kafka import KafkaConsumer
-from pymongo import MongoClient
+import functools
+import glob
+import hashlib
+import importlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
 import re
+import signal
 import string
-from bs4 import BeautifulSoup
-import emoji
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-import nltk
+import sys
+import tempfile
+import threading
+import time
 import warnings
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+_module_loaded_at = time.perf_counter()
+IMPORT_TIMES = {}
+
+def lazy_import(name):
+    """Import a module on first use, recording how long the import took"""
+    module = sys.modules.get(name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        IMPORT_TIMES[name] = time.perf_counter() - started
+    return module
+
+def pool_context():
+    """Multiprocessing context for worker pools.
+
+    fork is cheapest but unsafe once TensorFlow has started its thread
+    pools, so pools created after TensorFlow is loaded use forkserver (or
+    spawn). Workers then import only this module, whose heavy imports are lazy.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    if 'fork' in methods and 'tensorflow' not in sys.modules:
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def print_startup_report():
+    """Print the time spent in each deferred import since this module loaded"""
+    total = time.perf_counter() - _module_loaded_at
+    print(f"Startup time: {total:.2f}s")
+    for name, seconds in sorted(IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True):
+        print(f"  import {name}: {seconds:.2f}s")
+    print(f"  other: {total - sum(IMPORT_TIMES.values()):.2f}s")
+
+NLTK_RESOURCES = ['stopwords', 'wordnet', 'omw-1.4']
+
+def ensure_nltk_resources(download=False, required=False):
+    """Check NLTK corpora in the local data path, downloading only when asked.
+
+    Without the corpora, cleaning silently keeps stopwords and skips
+    lemmatization, so callers that train pass required=True to stop instead.
+    """
+    nltk = lazy_import('nltk')
+    missing = []
+    for resource in NLTK_RESOURCES:
+        try:
+            nltk.data.find(f'corpora/{resource}')
+        except LookupError:
+            try:
+                nltk.data.find(f'corpora/{resource}.zip')
+            except LookupError:
+                missing.append(resource)
+    if missing and download:
+        for resource in missing:
+            nltk.download(resource, quiet=True)
+        print(f"Downloaded NLTK resources: {', '.join(missing)}")
+        missing = []
+    if missing and required:
+        raise RuntimeError(
+            f"NLTK resources not found locally: {', '.join(missing)}. Training without them would skip "
+            "stopword removal or lemmatization when cleaning text; run with --download-nltk to fetch them"
+        )
+    if missing:
+        print(f"Warning: NLTK resources not found locally: {', '.join(missing)} (run with --download-nltk)")
+    return not missing
 
-try:
-    nltk.download('stopwords', quiet=True)
-    nltk.download('wordnet', quiet=True)
-    nltk.download('omw-1.4', quiet=True)
-    print("NLTK resources downloaded successfully")
-except Exception as e:
-    print(f"Error downloading NLTK resources: {e}")
+CHAT_WORDS = {
+    "AFAIK": "As Far As I Know",
+    "AFK": "Away From Keyboard",
+    "ASAP": "As Soon As Possible",
+    "ATM": "At The Moment",
+    "BRB": "Be Right Back",
+    "BTW": "By The Way",
+    "CU": "See You",
+    "FAQ": "Frequently Asked Questions",
+    "FWIW": "For What It's Worth",
+    "FYI": "For Your Information",
+    "GG": "Good Game",
+    "GN": "Good Night",
+    "IMHO": "In My Honest Opinion",
+    "IMO": "In My Opinion",
+    "IRL": "In Real Life",
+    "LOL": "Laughing Out Loud",
+    "ROFL": "Rolling On The Floor Laughing",
+    "THX": "Thank You",
+    "TTYL": "Talk To You Later",
+    "U": "You",
+    "WB": "Welcome Back",
+    "WTF": "What The...",
+    "ILY": "I Love You",
+    "JK": "Just Kidding",
+    "IDC": "I Don't Care",
+}
+URL_PATTERN = re.compile(r'http\S+|www\S+')
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+@functools.lru_cache(maxsize=None)
+def get_stop_words():
+    """Load the English stopword set once (lookup failures are not cached)"""
+    return frozenset(lazy_import('nltk.corpus').stopwords.words('english'))
+
+DEFAULT_BUNDLE_DIR = 'model_bundle'
+BUNDLE_FORMAT_VERSION = 1
+# Model file each load_bundle backend reads
+BUNDLE_BACKEND_ARTIFACTS = {'keras': 'model.keras', 'numpy': 'numpy_weights.npz', 'tflite': 'model.tflite'}
+ARCHITECTURES = ('lstm', 'gru', 'cnn', 'bag')
+
+@functools.lru_cache(maxsize=None)
+def masked_average_pooling_layer():
+    """GlobalAveragePooling1D that returns zeros instead of NaN for rows that are all padding.
+
+    Built on first use so Keras stays a lazy import; registering it lets
+    load_model read bundles that contain it.
+    """
+    keras = lazy_import('tensorflow.keras')
+
+    @keras.utils.register_keras_serializable(package='sentanaly')
+    class MaskedGlobalAveragePooling1D(keras.layers.GlobalAveragePooling1D):
+        def call(self, inputs, mask=None):
+            if mask is None:
+                return super().call(inputs)
+            weights = keras.ops.expand_dims(keras.ops.cast(mask, inputs.dtype), 2)
+            # Texts that clean to nothing encode as all padding; keep them out of 0/0
+            return keras.ops.sum(inputs * weights, axis=1) / keras.ops.maximum(keras.ops.sum(weights, axis=1), 1.0)
+
+    return MaskedGlobalAveragePooling1D
+
+class TextNormalizer:
+    """Single-pass equivalent of the stepwise clean_text chain, built on shared tables.
+
+    Every stage of the chain either works per whitespace token or cannot cross
+    a whitespace boundary, so each token is mapped once and joined at the end.
+    """
+    def __init__(self, lemmatizer=None, lemma_cache_size=100000):
+        try:
+            self.stop_words = get_stop_words()
+        except Exception as e:
+            print(f"Warning: Could not load stopwords: {e}")
+            self.stop_words = frozenset()
+        # Expansions are pre-split so each part still goes through the stopword filter
+        self.chat_words = {key: tuple(value.split()) for key, value in CHAT_WORDS.items()}
+        self.lemmatizer = lemmatizer
+        if lemmatizer is not None:
+            try:
+                lemmatizer.lemmatize('running', pos='v')
+            except Exception as e:
+                print(f"Warning: Lemmatizer unavailable, skipping lemmatization: {e}")
+                self.lemmatizer = None
+        self.demojize = lazy_import('emoji').demojize
+        self.lemma_cache_size = lemma_cache_size
+        self._lemma_cache = {}
+
+    def settings(self):
+        """The optional stages this normalizer actually applies; bundles record them for load_bundle to check"""
+        return {'stopwords': bool(self.stop_words), 'lemmatizer': self.lemmatizer is not None}
+
+    def cache_key(self):
+        """Short hash of everything normalize() output depends on, used as the clean-text cache partition"""
+        description = {
+            'stop_words': sorted(self.stop_words),
+            'lemmatizer': self.lemmatizer is not None,
+            'nltk': getattr(lazy_import('nltk'), '__version__', None),
+            'emoji': getattr(lazy_import('emoji'), '__version__', None),
+            # Code and tables, so editing the normalizer never serves entries cleaned by the old one
+            'code': inspect.getsource(TextNormalizer),
+            'chat_words': CHAT_WORDS,
+            'url_pattern': URL_PATTERN.pattern,
+            'punctuation': string.punctuation
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def _lemmatize(self, word):
+        lemma = self._lemma_cache.get(word)
+        if lemma is None:
+            lemma = self.lemmatizer.lemmatize(word, pos='v')
+            if len(self._lemma_cache) < self.lemma_cache_size:
+                self._lemma_cache[word] = lemma
+        return lemma
+
+    def normalize(self, text):
+        if not isinstance(text, str):
+            return ''
+        if '<' in text and '>' in text:
+            try:
+                text = lazy_import('bs4').BeautifulSoup(text, 'html.parser').get_text()
+            except Exception:
+                pass
+        words = []
+        for token in text.split():
+            if 'http' in token or 'www' in token:
+                token = URL_PATTERN.sub('', token)
+            token = token.translate(PUNCTUATION_TABLE)
+            if not token:
+                continue
+            for word in self.chat_words.get(token.upper(), (token,)):
+                if word.lower() in self.stop_words:
+                    continue
+                # Emojis are never ASCII, so plain words skip demojize entirely
+                if not word.isascii():
+                    try:
+                        word = self.demojize(word)
+                    except Exception:
+                        pass
+                if self.lemmatizer is not None:
+                    word = self._lemmatize(word)
+                words.append(word.lower())
+        return ' '.join(words)
 
 class RedditSentimentClassifier:
-    def __init__(self, max_words=50000, max_len=200, embedding_dim=200):
+    def __init__(self, max_words=50000, max_len=200, embedding_dim=200, tokenizer=None):
         self.max_words = max_words
         self.max_len = max_len
         self.embedding_dim = embedding_dim
-        self.tokenizer = Tokenizer(num_words=max_words, oov_token='<OOV>')
+        if tokenizer is None:
+            tokenizer = WordIndexTokenizer(num_words=max_words, oov_token='<OOV>')
+        self.tokenizer = tokenizer
         self.model = None
+        self.version = None
+        self.architecture = None
+        # Optional cascade: first_stage answers texts it is at least cascade_threshold confident about
+        self.first_stage = None
+        self.cascade_threshold = None
         self.wordnet_lemmatizer = None
         try:
-            self.wordnet_lemmatizer = WordNetLemmatizer()
+            self.wordnet_lemmatizer = lazy_import('nltk.stem').WordNetLemmatizer()
         except Exception as e:
             print(f"Warning: Could not initialize lemmatizer: {e}")
+        self.normalizer = TextNormalizer(self.wordnet_lemmatizer)
             
     def to_lower_case(self, text):
         return text.lower()
@@ -54,56 +266,28 @@ class RedditSentimentClassifier:
                 return ''
             # Check if the text looks like HTML before parsing
             if '<' in text and '>' in text:
-                soup = BeautifulSoup(text, 'html.parser')
+                soup = lazy_import('bs4').BeautifulSoup(text, 'html.parser')
                 return soup.get_text()
             return text
         except:
             return text
 
     def remove_urls(self, text):
-        return re.sub(r'http\S+|www\S+', '', text)
+        return URL_PATTERN.sub('', text)
 
     def remove_punctuation(self, text):
-        punctuation = string.punctuation
-        return text.translate(str.maketrans('', '', punctuation))
+        return text.translate(PUNCTUATION_TABLE)
 
     def replace_chat_words(self, text):
-        chat_words = {
-            "AFAIK": "As Far As I Know",
-            "AFK": "Away From Keyboard",
-            "ASAP": "As Soon As Possible",
-            "ATM": "At The Moment",
-            "BRB": "Be Right Back",
-            "BTW": "By The Way",
-            "CU": "See You",
-            "FAQ": "Frequently Asked Questions",
-            "FWIW": "For What It's Worth",
-            "FYI": "For Your Information",
-            "GG": "Good Game",
-            "GN": "Good Night",
-            "IMHO": "In My Honest Opinion",
-            "IMO": "In My Opinion",
-            "IRL": "In Real Life",
-            "LOL": "Laughing Out Loud",
-            "ROFL": "Rolling On The Floor Laughing",
-            "THX": "Thank You",
-            "TTYL": "Talk To You Later",
-            "U": "You",
-            "WB": "Welcome Back",
-            "WTF": "What The...",
-            "ILY": "I Love You",
-            "JK": "Just Kidding",
-            "IDC": "I Don't Care",
-        }
         words = text.split()
         for i, word in enumerate(words):
-            if word.upper() in chat_words:
-                words[i] = chat_words[word.upper()]
+            if word.upper() in CHAT_WORDS:
+                words[i] = CHAT_WORDS[word.upper()]
         return ' '.join(words)
 
     def remove_stopwords(self, text):
         try:
-            stop_words = set(stopwords.words('english'))
+            stop_words = get_stop_words()
             words = text.split()
             filtered_words = [word for word in words if word.lower() not in stop_words]
             return ' '.join(filtered_words)
@@ -112,7 +296,7 @@ class RedditSentimentClassifier:
 
     def remove_emojis(self, text):
         try:
-            return emoji.demojize(text)
+            return lazy_import('emoji').demojize(text)
         except:
             return text
 
@@ -125,6 +309,10 @@ class RedditSentimentClassifier:
             return text
 
     def clean_text(self, text):
+        return self.normalizer.normalize(text)
+
+    def clean_text_stepwise(self, text):
+        """Reference eight-stage cleaning chain that clean_text must reproduce"""
         if not isinstance(text, str):
             return ''
         try:
@@ -141,44 +329,86 @@ class RedditSentimentClassifier:
             print(f"Warning: Error in text cleaning: {e}")
             return text
 
-    def prepare_data(self, df):
+    def prepare_data(self, df, num_workers=None, chunk_size=2000, clean_cache_dir=None):
         """Prepare data for training"""
         print("Cleaning texts...")
         # Convert Spark DataFrame to pandas for text processing
         pdf = df.toPandas()
-        texts = pdf['Text'].apply(self.clean_text)
+        if clean_cache_dir:
+            texts = CleanTextCache(clean_cache_dir, self.normalizer).clean(pdf['Text'].tolist(), num_workers=num_workers, chunk_size=chunk_size)
+        else:
+            texts = clean_texts_parallel(pdf['Text'].tolist(), num_workers=num_workers, chunk_size=chunk_size)
         
         # Convert labels from [-1, 0, 1] to [0, 1, 2]
         labels = pdf['Label'].apply(lambda x: int(x + 1))
         
         print("Tokenizing texts...")
-        self.tokenizer.fit_on_texts(texts)
-        sequences = self.tokenizer.texts_to_sequences(texts)
-        padded_sequences = pad_sequences(sequences, maxlen=self.max_len, padding='post', truncating='post')
+        self.tokenizer.fit_on_texts(texts, num_workers=num_workers)
+        padded_sequences = self.tokenizer.encode(texts, self.max_len)
         
         return padded_sequences, labels.values
 
-    def build_model(self, num_classes=3):
-        """Build LSTM model architecture"""
-        self.model = Sequential([
-            # Removed input_length parameter from Embedding layer
-            Embedding(self.max_words, self.embedding_dim),
-            LSTM(256, return_sequences=True),
-            BatchNormalization(),
-            Dropout(0.3),
-            LSTM(128),
-            BatchNormalization(),
-            Dropout(0.3),
-            Dense(128, activation='relu'),
-            BatchNormalization(),
-            Dropout(0.3),
-            Dense(64, activation='relu'),
-            BatchNormalization(),
-            Dropout(0.3),
-            Dense(num_classes, activation='softmax')
+    def prepare_shards(self, df, shard_dir, num_workers=None, chunk_size=2000, rows_per_shard=100000, clean_cache_dir=None):
+        """Prepare data straight into .npy shards without building the full padded matrix"""
+        print("Cleaning texts...")
+        pdf = df.toPandas()
+        if clean_cache_dir:
+            texts = CleanTextCache(clean_cache_dir, self.normalizer).clean(pdf['Text'].tolist(), num_workers=num_workers, chunk_size=chunk_size)
+        else:
+            texts = clean_texts_parallel(pdf['Text'].tolist(), num_workers=num_workers, chunk_size=chunk_size)
+        # Convert labels from [-1, 0, 1] to [0, 1, 2]
+        labels = (pdf['Label'].values + 1).astype(np.int32)
+        del pdf
+        
+        print("Tokenizing texts...")
+        self.tokenizer.fit_on_texts(texts, num_workers=num_workers)
+        writer = SequenceShardWriter(shard_dir, self.max_len, rows_per_shard)
+        for start in range(0, len(texts), SHARD_CHUNK_ROWS):
+            writer.append(encode_texts(texts[start:start + SHARD_CHUNK_ROWS], self), labels[start:start + SHARD_CHUNK_ROWS])
+        writer.close()
+        return labels
+
+    def build_model(self, num_classes=3, mask_padding=True, lstm_units=(256, 128), learning_rate=0.001, architecture='lstm', units=128):
+        """Build the model: stacked LSTM (default), single GRU, 1D CNN with global max pooling or embedding bag"""
+        if architecture not in ARCHITECTURES:
+            raise ValueError(f"Unknown architecture {architecture!r}, expected one of {ARCHITECTURES}")
+        layers = lazy_import('tensorflow.keras.layers')
+        if architecture == 'cnn':
+            # Convolutions treat padding as ordinary positions, so inputs keep their full length
+            mask_padding = False
+        # Removed input_length parameter from Embedding layer.
+        # mask_zero makes the recurrent layers skip padding, so sequences can be batched at any length
+        model_layers = [layers.Embedding(self.max_words, self.embedding_dim, mask_zero=mask_padding)]
+        if architecture == 'lstm':
+            for i, layer_units in enumerate(lstm_units):
+                model_layers += [
+                    layers.LSTM(layer_units, return_sequences=i < len(lstm_units) - 1),
+                    layers.BatchNormalization(),
+                    layers.Dropout(0.3)
+                ]
+        elif architecture == 'gru':
+            model_layers += [layers.GRU(units), layers.BatchNormalization(), layers.Dropout(0.3)]
+        elif architecture == 'cnn':
+            model_layers += [
+                layers.Conv1D(units, 5, padding='same', activation='relu'),
+                layers.GlobalMaxPooling1D(),
+                layers.BatchNormalization(),
+                layers.Dropout(0.3)
+            ]
+        else:
+            model_layers += [masked_average_pooling_layer()(), layers.BatchNormalization(), layers.Dropout(0.3)]
+        self.architecture = architecture
+        self.model = lazy_import('tensorflow.keras.models').Sequential(model_layers + [
+            layers.Dense(128, activation='relu'),
+            layers.BatchNormalization(),
+            layers.Dropout(0.3),
+            layers.Dense(64, activation='relu'),
+            layers.BatchNormalization(),
+            layers.Dropout(0.3),
+            layers.Dense(num_classes, activation='softmax')
         ])
         
-        optimizer = Adam(learning_rate=0.001)
+        optimizer = lazy_import('tensorflow.keras.optimizers').Adam(learning_rate=learning_rate)
         self.model.compile(
             optimizer=optimizer,
             loss='sparse_categorical_crossentropy',
@@ -187,192 +417,2713 @@ class RedditSentimentClassifier:
         
         return self.model
 
-    def train(self, X_train, y_train, X_val, y_val, epochs=10, batch_size=64):
-        """Train the model"""
-        class_weights = compute_class_weight(
-            'balanced',
-            classes=np.unique(y_train),
-            y=y_train
-        )
-        class_weight_dict = dict(enumerate(class_weights))
-        
+    def _training_callbacks(self, checkpoint_path='best_model.keras'):
+        keras_callbacks = lazy_import('tensorflow.keras.callbacks')
         callbacks = [
-            EarlyStopping(
+            keras_callbacks.EarlyStopping(
                 monitor='val_loss',
                 patience=3,
                 restore_best_weights=True
-            ),
-            ModelCheckpoint(
-                'best_model.keras',  # Changed file extension to .keras
-                monitor='val_accuracy',
-                save_best_only=True
             )
         ]
+        if checkpoint_path:
+            callbacks.append(keras_callbacks.ModelCheckpoint(
+                checkpoint_path,  # Changed file extension to .keras
+                monitor='val_accuracy',
+                save_best_only=True
+            ))
+        return callbacks
+
+    def train(self, X_train, y_train, X_val, y_val, epochs=10, batch_size=64, bucket_by_length=True, checkpoint_path='best_model.keras', verbose='auto'):
+        """Train the model"""
+        class_weights = balanced_class_weights(y_train)
+        # Batches are padded only to their bucket's longest sequence when the model masks padding
+        bucket = bucket_by_length and masks_padding(self.model)
+        history = self.model.fit(
+            make_array_dataset(X_train, y_train, batch_size, class_weights=class_weights, shuffle=True, bucket=bucket),
+            validation_data=make_array_dataset(X_val, y_val, batch_size, bucket=bucket),
+            epochs=epochs,
+            callbacks=self._training_callbacks(checkpoint_path),
+            verbose=verbose
+        )
         
+        return history
+
+    def distill(self, X_train, soft_targets, X_val, y_val, epochs=10, batch_size=64, learning_rate=0.001, bucket_by_length=True, verbose='auto'):
+        """Train the model to match teacher probabilities; validation still uses the true labels"""
+        optimizer = lazy_import('tensorflow.keras.optimizers').Adam(learning_rate=learning_rate)
+        self.model.compile(optimizer=optimizer, loss='categorical_crossentropy', metrics=['accuracy'])
+        bucket = bucket_by_length and masks_padding(self.model)
+        val_targets = np.eye(soft_targets.shape[1], dtype=np.float32)[np.asarray(y_val)]
+        return self.model.fit(
+            make_array_dataset(X_train, soft_targets, batch_size, shuffle=True, bucket=bucket),
+            validation_data=make_array_dataset(X_val, val_targets, batch_size, bucket=bucket),
+            epochs=epochs,
+            callbacks=self._training_callbacks(None),
+            verbose=verbose
+        )
+
+    def train_on_shards(self, shard_dir, train_indices=None, val_indices=None, epochs=10, batch_size=64, shuffle_buffer=10000, bucket_by_length=True):
+        """Train from on-disk sequence shards through a streaming tf.data pipeline"""
+        labels = load_shard_labels(shard_dir)
+        class_weights = balanced_class_weights(labels if train_indices is None else labels[train_indices])
+        bucket = bucket_by_length and masks_padding(self.model)
         history = self.model.fit(
-            X_train,
-            y_train,
-            validation_data=(X_val, y_val),
+            make_shard_dataset(shard_dir, batch_size, indices=train_indices, class_weights=class_weights, shuffle_buffer=shuffle_buffer, bucket=bucket),
+            validation_data=make_shard_dataset(shard_dir, batch_size, indices=val_indices, bucket=bucket),
             epochs=epochs,
-            batch_size=batch_size,
-            class_weight=class_weight_dict,
-            callbacks=callbacks
+            callbacks=self._training_callbacks()
         )
         
         return history
+
+    def save_bundle(self, bundle_dir=DEFAULT_BUNDLE_DIR, version=None, tflite_quantization=None, representative_data=None):
+        """Save model, tokenizer vocabulary and shape settings as a versioned bundle"""
+        check_tflite_quantization(tflite_quantization, self.architecture)
+        if tflite_quantization == 'int8' and representative_data is None:
+            # Fail before anything is written rather than leaving a bundle without LATEST
+            raise ValueError("int8 TFLite export needs representative_data (a sample of training sequences)")
+        version = version or datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        version_dir = os.path.join(bundle_dir, version)
+        os.makedirs(version_dir, exist_ok=True)
+        self.model.save(os.path.join(version_dir, 'model.keras'))
+        with open(os.path.join(version_dir, 'tokenizer.json'), 'w', encoding='utf-8') as f:
+            f.write(self.tokenizer.to_json())
+        if isinstance(self.tokenizer, WordIndexTokenizer):
+            self.tokenizer.save_vocabulary(os.path.join(version_dir, 'vocabulary.txt'))
+        export_numpy_weights(self.model, os.path.join(version_dir, 'numpy_weights.npz'))
+        if self.first_stage is not None:
+            self.first_stage.save(os.path.join(version_dir, 'first_stage.npz'))
+        with open(os.path.join(version_dir, 'config.json'), 'w', encoding='utf-8') as f:
+            json.dump({
+                'format_version': BUNDLE_FORMAT_VERSION,
+                'version': version,
+                'max_words': self.max_words,
+                'max_len': self.max_len,
+                'embedding_dim': self.embedding_dim,
+                'architecture': self.architecture,
+                'normalizer': self.normalizer.settings(),
+                'cascade_threshold': self.cascade_threshold if self.first_stage is not None else None
+            }, f, indent=2)
+        if tflite_quantization:
+            export_tflite(self, os.path.join(version_dir, 'model.tflite'), quantization=tflite_quantization, representative_data=representative_data)
+        # Write the pointer last so a crash mid-save never exposes a partial bundle
+        with open(os.path.join(bundle_dir, 'LATEST'), 'w', encoding='utf-8') as f:
+            f.write(version)
+        self.version = version
+        print(f"Saved model bundle {version} to {version_dir}")
+        return version_dir
+
+    @classmethod
+    def load_bundle(cls, bundle_dir=DEFAULT_BUNDLE_DIR, version=None, backend='keras', cascade=False):
+        """Load a serve-ready classifier from a saved bundle (latest version by default)"""
+        version = version or resolve_bundle_version(bundle_dir)
+        version_dir = os.path.join(bundle_dir, version)
+        with open(os.path.join(version_dir, 'config.json'), encoding='utf-8') as f:
+            config = json.load(f)
+        if config.get('format_version') != BUNDLE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported bundle format {config.get('format_version')} in {version_dir}")
+        vocabulary_path = os.path.join(version_dir, 'vocabulary.txt')
+        if os.path.exists(vocabulary_path):
+            # Much faster to parse than the nested JSON of tokenizer.json
+            tokenizer = WordIndexTokenizer.load_vocabulary(vocabulary_path)
+        else:
+            with open(os.path.join(version_dir, 'tokenizer.json'), encoding='utf-8') as f:
+                tokenizer = WordIndexTokenizer.from_json(f.read())
+        classifier = cls(
+            max_words=config['max_words'],
+            max_len=config['max_len'],
+            embedding_dim=config['embedding_dim'],
+            tokenizer=tokenizer
+        )
+        trained_with = config.get('normalizer')
+        if trained_with is not None and trained_with != classifier.normalizer.settings():
+            # Serving must clean text the way training did, or predictions skew without any error
+            raise RuntimeError(
+                f"Bundle {version} was trained with text normalizer settings {trained_with}, but this process has "
+                f"{classifier.normalizer.settings()}; install the same NLTK corpora (--download-nltk)"
+            )
+        artifact_path = os.path.join(version_dir, BUNDLE_BACKEND_ARTIFACTS[backend])
+        if backend == 'numpy':
+            classifier.model = NumpyLSTMModel(artifact_path)
+        elif backend == 'tflite':
+            classifier.model = TFLiteModel(artifact_path)
+        else:
+            # No optimizer state is needed to serve; 'bag' bundles need the custom pooling layer registered
+            masked_average_pooling_layer()
+            classifier.model = lazy_import('tensorflow.keras.models').load_model(artifact_path, compile=False)
+        classifier.version = version
+        classifier.architecture = config.get('architecture', 'lstm')
+        if cascade and config.get('cascade_threshold') is not None:
+            classifier.first_stage = HashedBagOfWordsClassifier.load(os.path.join(version_dir, 'first_stage.npz'))
+            classifier.cascade_threshold = config['cascade_threshold']
+        print(f"Loaded model bundle {version} from {version_dir}")
+        return classifier
+LENGTH_BUCKETS = (8, 16, 32, 64, 128)
+
+def masks_padding(model):
+    """Whether a serving backend ignores padded steps, so batches may be trimmed to any length"""
+    if hasattr(model, 'mask_zero'):
+        return model.mask_zero
+    layers = getattr(model, 'layers', None)
+    return bool(layers) and getattr(layers[0], 'mask_zero', False)
+
+def balanced_class_weights(labels):
+    """'balanced' class weights as a vector indexed by label, for per-example sample weights"""
+    compute_class_weight = lazy_import('sklearn.utils.class_weight').compute_class_weight
+    labels = np.asarray(labels)
+    classes = np.unique(labels)
+    weights = np.ones(int(classes.max()) + 1, dtype=np.float32)
+    weights[classes] = compute_class_weight('balanced', classes=classes, y=labels)
+    return weights
+
+def batch_sequence_dataset(dataset, batch_size, bucket=True, boundaries=LENGTH_BUCKETS):
+    """Batch (sequence, label, weight) elements, grouped by length bucket when bucket is set"""
+    tf = lazy_import('tensorflow')
+    if not bucket:
+        return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+    dataset = dataset.map(
+        lambda sequence, label, weight: (
+            sequence[:tf.maximum(tf.math.count_nonzero(sequence, dtype=tf.int32), 1)], label, weight
+        ),
+        num_parallel_calls=tf.data.AUTOTUNE
+    )
+    dataset = dataset.bucket_by_sequence_length(
+        element_length_func=lambda sequence, label, weight: tf.shape(sequence)[0],
+        # tf buckets are half-open [lower, upper), ours include the boundary
+        bucket_boundaries=[boundary + 1 for boundary in boundaries],
+        bucket_batch_sizes=[batch_size] * (len(boundaries) + 1)
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+def make_array_dataset(X, y, batch_size, class_weights=None, shuffle=False, bucket=True):
+    """tf.data pipeline over in-memory arrays with class weights applied as sample weights.
+
+    y holds integer labels, or per-class probability rows for distillation (no class weights then).
+    """
+    tf = lazy_import('tensorflow')
+    y = np.asarray(y)
+    y = y.astype(np.float32) if y.ndim == 2 else y.astype(np.int32)
+    sample_weights = class_weights[y] if class_weights is not None else np.ones(len(y), dtype=np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices((X, y, sample_weights))
+    if shuffle:
+        dataset = dataset.shuffle(min(len(y), 10000), reshuffle_each_iteration=True)
+    return batch_sequence_dataset(dataset, batch_size, bucket=bucket)
+
+SHARD_CHUNK_ROWS = 4096
+
+def list_shards(shard_dir):
+    """Return the (sequence, label) .npy file pairs of a shard directory in order"""
+    sequence_paths = sorted(glob.glob(os.path.join(shard_dir, 'sequences-*.npy')))
+    label_paths = [
+        os.path.join(shard_dir, os.path.basename(path).replace('sequences-', 'labels-', 1))
+        for path in sequence_paths
+    ]
+    if not sequence_paths:
+        raise FileNotFoundError(f"No sequence shards in {shard_dir}")
+    return sequence_paths, label_paths
+
+class SequenceShardWriter:
+    """Stream padded sequences and labels into numbered .npy shards of a fixed row count"""
+    def __init__(self, shard_dir, max_len, rows_per_shard=100000):
+        self.shard_dir = shard_dir
+        self.rows_per_shard = rows_per_shard
+        self.rows_written = 0
+        self.shard_count = 0
+        # One shard's worth of rows is the most this ever holds in memory
+        self._sequences = np.zeros((rows_per_shard, max_len), dtype=np.int32)
+        self._labels = np.zeros(rows_per_shard, dtype=np.int32)
+        self._filled = 0
+        os.makedirs(shard_dir, exist_ok=True)
+        for stale_path in glob.glob(os.path.join(shard_dir, '*.npy')):
+            os.remove(stale_path)
+
+    def append(self, sequences, labels):
+        start = 0
+        while start < len(labels):
+            count = min(self.rows_per_shard - self._filled, len(labels) - start)
+            self._sequences[self._filled:self._filled + count] = sequences[start:start + count]
+            self._labels[self._filled:self._filled + count] = labels[start:start + count]
+            self._filled += count
+            start += count
+            if self._filled == self.rows_per_shard:
+                self._flush()
+
+    def _flush(self):
+        if not self._filled:
+            return
+        np.save(os.path.join(self.shard_dir, f'sequences-{self.shard_count:05d}.npy'), self._sequences[:self._filled])
+        np.save(os.path.join(self.shard_dir, f'labels-{self.shard_count:05d}.npy'), self._labels[:self._filled])
+        self.rows_written += self._filled
+        self.shard_count += 1
+        self._filled = 0
+
+    def close(self):
+        self._flush()
+        self._sequences = self._labels = None
+        return self.rows_written
+
+def load_shard_labels(shard_dir):
+    return np.concatenate([np.load(path) for path in list_shards(shard_dir)[1]])
+
+def shard_row_selection(shard_dir, indices=None):
+    """Split sorted global row indices into per-shard local row arrays"""
+    sequence_paths, label_paths = list_shards(shard_dir)
+    sizes = [np.load(path, mmap_mode='r').shape[0] for path in label_paths]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    if indices is None:
+        return [np.arange(size) for size in sizes]
+    indices = np.sort(np.asarray(indices))
+    bounds = np.searchsorted(indices, offsets)
+    return [indices[bounds[i]:bounds[i + 1]] - offsets[i] for i in range(len(sizes))]
+
+def read_shard_rows(shard_dir, indices=None):
+    """Materialize the selected rows (in sorted index order) as (sequences, labels) arrays"""
+    sequence_paths, label_paths = list_shards(shard_dir)
+    selection = shard_row_selection(shard_dir, indices)
+    sequences = [np.load(path, mmap_mode='r')[rows] for path, rows in zip(sequence_paths, selection)]
+    labels = [np.load(path, mmap_mode='r')[rows] for path, rows in zip(label_paths, selection)]
+    return np.concatenate(sequences).astype(np.int32), np.concatenate(labels).astype(np.int32)
+
+def split_indices(num_rows, test_size=0.3, random_state=42):
+    """Train/val/test row indices matching the train_test_split calls on the full arrays"""
+    train_test_split = lazy_import('sklearn.model_selection').train_test_split
+    train_indices, temp_indices = train_test_split(np.arange(num_rows), test_size=test_size, random_state=random_state)
+    val_indices, test_indices = train_test_split(temp_indices, test_size=0.5, random_state=random_state)
+    return np.sort(train_indices), np.sort(val_indices), np.sort(test_indices)
+
+def make_shard_dataset(shard_dir, batch_size, indices=None, class_weights=None, shuffle_buffer=0, bucket=True):
+    """Streaming tf.data pipeline over .npy shards: interleaved reads, bounded shuffle, prefetch"""
+    tf = lazy_import('tensorflow')
+    sequence_paths, label_paths = list_shards(shard_dir)
+    selection = shard_row_selection(shard_dir, indices)
+    max_len = np.load(sequence_paths[0], mmap_mode='r').shape[1]
+
+    def read_chunks(position):
+        # Memory-mapped so only the rows being yielded are paged in
+        sequences = np.load(sequence_paths[position], mmap_mode='r')
+        labels = np.load(label_paths[position], mmap_mode='r')
+        rows = selection[position]
+        for start in range(0, len(rows), SHARD_CHUNK_ROWS):
+            chunk = rows[start:start + SHARD_CHUNK_ROWS]
+            yield np.asarray(sequences[chunk], dtype=np.int32), np.asarray(labels[chunk], dtype=np.int32)
+
+    signature = (tf.TensorSpec([None, max_len], tf.int32), tf.TensorSpec([None], tf.int32))
+    positions = tf.data.Dataset.range(len(sequence_paths))
+    if shuffle_buffer:
+        positions = positions.shuffle(len(sequence_paths), reshuffle_each_iteration=True)
+    dataset = positions.interleave(
+        lambda position: tf.data.Dataset.from_generator(
+            read_chunks, args=(position,), output_signature=signature
+        ),
+        cycle_length=min(4, len(sequence_paths)),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=not shuffle_buffer
+    ).unbatch()
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    if class_weights is not None:
+        weights = tf.constant(class_weights, dtype=tf.float32)
+        dataset = dataset.map(lambda sequence, label: (sequence, label, tf.gather(weights, label)))
+    else:
+        dataset = dataset.map(lambda sequence, label: (sequence, label, tf.ones([], tf.float32)))
+    return batch_sequence_dataset(dataset, batch_size, bucket=bucket)
+
+def predict_bucketed(model, padded_sequences, boundaries=LENGTH_BUCKETS):
+    """predict_on_batch per length bucket, trimming trailing padding when the model masks it"""
+    padded_sequences = np.asarray(padded_sequences)
+    if len(padded_sequences) == 0 or not masks_padding(model):
+        return np.asarray(model.predict_on_batch(padded_sequences))
+    max_len = padded_sequences.shape[1]
+    lengths = np.count_nonzero(padded_sequences, axis=1)
+    bucket_ids = np.searchsorted(boundaries, lengths, side='left')
+    predictions = None
+    for bucket_id in np.unique(bucket_ids):
+        rows = np.nonzero(bucket_ids == bucket_id)[0]
+        # Pad to the bucket boundary rather than the exact max so Keras sees few distinct shapes
+        width = boundaries[bucket_id] if bucket_id < len(boundaries) else max_len
+        bucket_predictions = np.asarray(model.predict_on_batch(padded_sequences[rows, :min(width, max_len)]))
+        if predictions is None:
+            predictions = np.empty((len(padded_sequences), bucket_predictions.shape[1]), dtype=bucket_predictions.dtype)
+        predictions[rows] = bucket_predictions
+    return predictions
+
+def resolve_bundle_version(bundle_dir=DEFAULT_BUNDLE_DIR):
+    """Return the version the bundle directory's LATEST pointer refers to"""
+    latest_path = os.path.join(bundle_dir, 'LATEST')
+    if not os.path.exists(latest_path):
+        raise FileNotFoundError(f"No model bundle found in {bundle_dir}")
+    with open(latest_path, encoding='utf-8') as f:
+        return f.read().strip()
+TFLITE_QUANTIZATIONS = ('dynamic', 'float16', 'int8', 'none')
+# Rows of training data int8 conversion calibrates activation ranges on
+TFLITE_CALIBRATION_ROWS = 1600
+# Calibrating LSTM/GRU models for int8 crashes the TFLite converter process (SIGSEGV)
+TFLITE_INT8_ARCHITECTURES = ('cnn', 'bag')
+
+def check_tflite_quantization(quantization, architecture):
+    """Reject TFLite settings that export_tflite cannot handle, before any training happens"""
+    if quantization and quantization not in TFLITE_QUANTIZATIONS:
+        raise ValueError(f"Unknown tflite_quantization {quantization!r}, expected one of {TFLITE_QUANTIZATIONS}")
+    if quantization == 'int8' and architecture not in TFLITE_INT8_ARCHITECTURES:
+        raise ValueError(
+            f"int8 TFLite export is only supported for {', '.join(TFLITE_INT8_ARCHITECTURES)} models, not {architecture!r}; "
+            "use 'dynamic' or 'float16'"
+        )
+
+def export_tflite(classifier, output_path, quantization='dynamic', representative_data=None, batch_size=32):
+    """Convert the trained Keras model to a TensorFlow Lite flatbuffer.
+
+    quantization is 'dynamic' (int8 weights, float activations), 'float16',
+    'int8' (weights and activations, calibrated on representative_data) or 'none'.
+    """
+    if quantization not in TFLITE_QUANTIZATIONS:
+        raise ValueError(f"Unknown TFLite quantization {quantization!r}, expected one of {TFLITE_QUANTIZATIONS}")
+    tf = lazy_import('tensorflow')
+    keras = lazy_import('tensorflow.keras')
+    # A fully static input shape lets the LSTMs lower to fused builtin kernels;
+    # the converted graph cannot be resized afterwards, so TFLiteModel feeds it fixed-size chunks
+    inputs = keras.Input(batch_shape=(batch_size, classifier.max_len), dtype='int32')
+    serving_model = keras.Model(inputs, classifier.model(inputs))
+
+    def build_converter(select_ops):
+        converter = tf.lite.TFLiteConverter.from_keras_model(serving_model)
+        if quantization != 'none':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        if quantization == 'int8':
+            if representative_data is None:
+                raise ValueError("int8 quantization needs representative_data for calibration")
+            calibration_rows = len(representative_data) - len(representative_data) % batch_size
+            converter.representative_dataset = lambda: (
+                [representative_data[start:start + batch_size].astype(np.int32)]
+                for start in range(0, min(calibration_rows, TFLITE_CALIBRATION_ROWS), batch_size)
+            )
+        if select_ops:
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+            converter._experimental_lower_tensor_list_ops = False
+        return converter
+
+    try:
+        flatbuffer = build_converter(select_ops=False).convert()
+    except Exception as e:
+        print(f"Warning: builtin-only TFLite conversion failed ({e}), retrying with select TF ops")
+        flatbuffer = build_converter(select_ops=True).convert()
+    with open(output_path, 'wb') as f:
+        f.write(flatbuffer)
+    print(f"Exported {quantization} TFLite model ({len(flatbuffer) / 1e6:.1f} MB) to {output_path}")
+    return output_path
+
+class TFLiteModel:
+    """TFLite interpreter exposing the predict_on_batch interface get_sentiments uses"""
+    def __init__(self, model_path, num_threads=None):
+        try:
+            # The standalone runtime avoids loading all of TensorFlow
+            Interpreter = lazy_import('tflite_runtime.interpreter').Interpreter
+        except ImportError:
+            Interpreter = lazy_import('tensorflow').lite.Interpreter
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = int(self.input_detail['shape'][0])
+        # The flatbuffer has a fixed (batch, max_len) input, so batches are never trimmed
+        self.mask_zero = False
+
+    def predict_on_batch(self, padded_sequences):
+        padded_sequences = np.asarray(padded_sequences, dtype=self.input_detail['dtype'])
+        rows = len(padded_sequences)
+        outputs = []
+        # The graph has a static batch dimension: run full chunks, zero-padding the last one
+        for start in range(0, rows, self.batch_size):
+            chunk = padded_sequences[start:start + self.batch_size]
+            if len(chunk) < self.batch_size:
+                chunk = np.concatenate([chunk, np.zeros((self.batch_size - len(chunk),) + chunk.shape[1:], dtype=chunk.dtype)])
+            self.interpreter.set_tensor(self.input_detail['index'], chunk)
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output_index)[:rows - start].copy())
+        return np.concatenate(outputs) if outputs else np.zeros((0, 3), dtype=np.float32)
+
+def compare_backends(reference_model, candidate_model, X, y, batch_size=256):
+    """Compare two predict_on_batch backends on held-out data: accuracy, agreement and latency"""
+    reference_probs, candidate_probs = [], []
+    reference_time = candidate_time = 0.0
+    for start in range(0, len(X), batch_size):
+        batch = X[start:start + batch_size]
+        started = time.perf_counter()
+        reference_probs.append(np.asarray(reference_model.predict_on_batch(batch)))
+        reference_time += time.perf_counter() - started
+        started = time.perf_counter()
+        candidate_probs.append(np.asarray(candidate_model.predict_on_batch(batch)))
+        candidate_time += time.perf_counter() - started
+    reference_probs = np.concatenate(reference_probs)
+    candidate_probs = np.concatenate(candidate_probs)
+    reference_labels = reference_probs.argmax(axis=1)
+    candidate_labels = candidate_probs.argmax(axis=1)
+    num_batches = max(1, -(-len(X) // batch_size))
+    return {
+        'examples': int(len(X)),
+        'reference_accuracy': float(np.mean(reference_labels == y)),
+        'candidate_accuracy': float(np.mean(candidate_labels == y)),
+        'label_agreement': float(np.mean(reference_labels == candidate_labels)),
+        'max_probability_diff': float(np.max(np.abs(reference_probs - candidate_probs))),
+        'reference_ms_per_batch': reference_time * 1000 / num_batches,
+        'candidate_ms_per_batch': candidate_time * 1000 / num_batches
+    }
+
+def report_backend_parity(classifier, version_dir, backend, X_test, y_test):
+    """Check an exported serving backend against Keras on the test split and save the report"""
+    artifact = BUNDLE_BACKEND_ARTIFACTS[backend]
+    artifact_path = os.path.join(version_dir, artifact)
+    candidate = TFLiteModel(artifact_path) if backend == 'tflite' else NumpyLSTMModel(artifact_path)
+    report = compare_backends(classifier.model, candidate, X_test, y_test)
+    report[f'{backend}_size_mb'] = os.path.getsize(artifact_path) / 1e6
+    report['keras_size_mb'] = os.path.getsize(os.path.join(version_dir, 'model.keras')) / 1e6
+    with open(os.path.join(version_dir, f'{backend}_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(
+        f"{backend} parity: {report['label_agreement']:.2%} label agreement, "
+        f"max probability diff {report['max_probability_diff']:.2e}, "
+        f"accuracy {report['candidate_accuracy']:.4f} vs Keras {report['reference_accuracy']:.4f}, "
+        f"{report['candidate_ms_per_batch']:.1f} vs {report['reference_ms_per_batch']:.1f} ms/batch"
+    )
+    return report
+VOCABULARY_FORMAT_VERSION = 1
+
+def _count_words_chunk(texts):
+    # One lower/translate/split over the joined chunk; Counter keeps first-occurrence order
+    joined = ' '.join(texts).lower().translate(KERAS_FILTER_TABLE)
+    return Counter(word for word in joined.split(' ') if word)
+
+class WordIndexTokenizer:
+    """TensorFlow-free replacement for keras Tokenizer with identical word ranking and encoding"""
+    def __init__(self, word_index=None, num_words=None, oov_token=None, tokenizer_json=None, word_counts=None):
+        self.num_words = num_words
+        self.oov_token = oov_token
+        self.word_counts = word_counts or {}
+        self.tokenizer_json = tokenizer_json
+        self._set_word_index(word_index or {})
+
+    def _set_word_index(self, word_index):
+        self.word_index = word_index
+        self.oov_index = word_index.get(self.oov_token) if self.oov_token is not None else None
+        # Lookup table with the num_words cap already applied, so encoding is one dict get per word
+        self._lookup = {
+            word: (index if not self.num_words or index < self.num_words else self.oov_index)
+            for word, index in word_index.items()
+        }
+        if self.oov_index is None:
+            self._lookup = {word: index for word, index in self._lookup.items() if index is not None}
+
+    @classmethod
+    def from_json(cls, tokenizer_json):
+        config = json.loads(tokenizer_json)['config']
+        # keras stores the word index as a JSON string inside the config
+        word_index = json.loads(config['word_index'])
+        return cls(word_index, config['num_words'], config['oov_token'], tokenizer_json)
+
+    def to_json(self):
+        """keras tokenizer_from_json compatible JSON"""
+        if self.tokenizer_json is not None:
+            return self.tokenizer_json
+        return json.dumps({
+            'class_name': 'Tokenizer',
+            'config': {
+                'num_words': self.num_words,
+                'filters': KERAS_FILTERS,
+                'lower': True,
+                'split': ' ',
+                'char_level': False,
+                'oov_token': self.oov_token,
+                'document_count': 0,
+                'word_counts': json.dumps(self.word_counts),
+                'word_docs': json.dumps({}),
+                'index_docs': json.dumps({}),
+                'index_word': json.dumps({str(index): word for word, index in self.word_index.items()}),
+                'word_index': json.dumps(self.word_index)
+            }
+        })
+
+    def set_vocabulary(self, vocabulary):
+        """Index a ranked [(word, count)] vocabulary the way fit_on_texts does"""
+        self.word_counts = OrderedDict(vocabulary)
+        ranked_words = [word for word, _ in vocabulary]
+        if self.oov_token is not None:
+            ranked_words = [self.oov_token] + ranked_words
+        self.tokenizer_json = None
+        self._set_word_index(dict(zip(ranked_words, range(1, len(ranked_words) + 1))))
+
+    def fit_on_texts(self, texts, num_workers=None, chunk_size=20000):
+        """Count words on a process pool and rank them by count, ties by first occurrence"""
+        texts = [text if isinstance(text, str) else str(text) for text in texts]
+        chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        num_workers = min(num_workers or os.cpu_count() or 1, len(chunks))
+        counts = Counter()
+        if num_workers <= 1:
+            for chunk in chunks:
+                counts.update(_count_words_chunk(chunk))
+        else:
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=pool_context()) as pool:
+                # Merging in chunk order keeps global first-occurrence order for the tie-break
+                for chunk_count in pool.map(_count_words_chunk, chunks):
+                    counts.update(chunk_count)
+        # Stable sort, same as keras: equal counts stay in first-occurrence order
+        self.set_vocabulary(sorted(counts.items(), key=lambda item: item[1], reverse=True))
+        return self
+
+    def encode(self, texts, max_len):
+        """Encode texts straight into a post-padded, post-truncated int32 matrix"""
+        lookup = self._lookup.get
+        oov_index = self.oov_index
+        lengths = np.zeros(len(texts), dtype=np.int64)
+        flat = []
+        for row, text in enumerate(texts):
+            indices = [lookup(word, oov_index) for word in keras_words(text)]
+            if oov_index is None:
+                indices = [index for index in indices if index is not None]
+            indices = indices[:max_len]
+            lengths[row] = len(indices)
+            flat.extend(indices)
+        matrix = np.zeros((len(texts), max_len), dtype=np.int32)
+        if flat:
+            rows = np.repeat(np.arange(len(texts)), lengths)
+            starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+            matrix[rows, np.arange(len(flat)) - starts] = flat
+        return matrix
+
+    def texts_to_sequences(self, texts):
+        lookup = self._lookup.get
+        oov_index = self.oov_index
+        sequences = []
+        for text in texts:
+            sequence = [lookup(word, oov_index) for word in keras_words(text)]
+            if oov_index is None:
+                sequence = [index for index in sequence if index is not None]
+            sequences.append(sequence)
+        return sequences
+
+    def save_vocabulary(self, path):
+        """Write a compact vocabulary file: a JSON header line, then one word per line in index order"""
+        words = [None] * len(self.word_index)
+        for word, index in self.word_index.items():
+            words[index - 1] = word
+        header = {'format_version': VOCABULARY_FORMAT_VERSION, 'num_words': self.num_words, 'oov_token': self.oov_token}
+        # keras filters strip '\n', so no word can contain the separator
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(json.dumps(header) + '\n' + '\n'.join(words))
+
+    @classmethod
+    def load_vocabulary(cls, path):
+        with open(path, encoding='utf-8', newline='') as f:
+            header_line, _, body = f.read().partition('\n')
+        header = json.loads(header_line)
+        if header.get('format_version') != VOCABULARY_FORMAT_VERSION:
+            raise ValueError(f"Unsupported vocabulary format {header.get('format_version')} in {path}")
+        words = body.split('\n') if body else []
+        return cls(dict(zip(words, range(1, len(words) + 1))), header['num_words'], header['oov_token'])
+
+NUMPY_LAYER_WEIGHTS = {
+    'Embedding': ['embeddings'],
+    'LSTM': ['kernel', 'recurrent_kernel', 'bias'],
+    'GRU': ['kernel', 'recurrent_kernel', 'bias'],
+    'Conv1D': ['kernel', 'bias'],
+    'GlobalMaxPooling1D': [],
+    'GlobalAveragePooling1D': [],
+    'MaskedGlobalAveragePooling1D': [],
+    'Dense': ['kernel', 'bias'],
+    'BatchNormalization': ['gamma', 'beta', 'moving_mean', 'moving_variance'],
+    'Dropout': []
+}
+
+def export_numpy_weights(model, output_path):
+    """Save a Sequential model's layer weights and layout as plain arrays for NumpyLSTMModel"""
+    spec = []
+    arrays = {}
+    for i, layer in enumerate(model.layers):
+        kind = type(layer).__name__
+        if kind not in NUMPY_LAYER_WEIGHTS:
+            raise ValueError(f"NumPy export does not support {kind} layers")
+        config = layer.get_config()
+        entry = {'type': kind, 'weights': []}
+        if kind == 'Embedding':
+            entry['mask_zero'] = config.get('mask_zero', False)
+        elif kind == 'LSTM':
+            if config['activation'] != 'tanh' or config['recurrent_activation'] != 'sigmoid':
+                raise ValueError("NumPy export only supports tanh/sigmoid LSTMs")
+            entry['return_sequences'] = config['return_sequences']
+        elif kind == 'GRU':
+            if config['activation'] != 'tanh' or config['recurrent_activation'] != 'sigmoid' or not config['reset_after']:
+                raise ValueError("NumPy export only supports tanh/sigmoid GRUs with reset_after")
+            entry['return_sequences'] = config['return_sequences']
+        elif kind == 'Conv1D':
+            if tuple(config['strides']) != (1,) or tuple(config['dilation_rate']) != (1,) or config['padding'] not in ('same', 'valid'):
+                raise ValueError("NumPy export only supports stride-1, undilated same/valid Conv1D")
+            entry['padding'] = config['padding']
+            entry['activation'] = config['activation']
+        elif kind in ('GlobalMaxPooling1D', 'GlobalAveragePooling1D', 'MaskedGlobalAveragePooling1D'):
+            if config.get('keepdims') or config.get('data_format', 'channels_last') != 'channels_last':
+                raise ValueError(f"NumPy export only supports channels_last {kind} without keepdims")
+        elif kind == 'Dense':
+            entry['activation'] = config['activation']
+        elif kind == 'BatchNormalization':
+            entry['epsilon'] = config['epsilon']
+        for name, weight in zip(NUMPY_LAYER_WEIGHTS[kind], layer.get_weights()):
+            key = f'{i}_{name}'
+            arrays[key] = np.asarray(weight, dtype=np.float32)
+            entry['weights'].append(key)
+        spec.append(entry)
+    np.savez(output_path, __spec__=np.array(json.dumps(spec)), **arrays)
+    return output_path
+
+def _sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+def _softmax(x):
+    exp = np.exp(x - x.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+NUMPY_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0.0),
+    'tanh': np.tanh,
+    'sigmoid': _sigmoid,
+    'softmax': _softmax
+}
+
+class NumpyLSTMModel:
+    """TensorFlow-free forward pass over weights saved by export_numpy_weights.
+
+    Inference-mode BatchNormalization is folded into the input weights of the
+    following Dense/LSTM layer, Dropout is dropped, and each LSTM step runs one
+    matmul over the whole batch with the input and recurrent kernels stacked.
+    GRU, Conv1D and global pooling layers cover the other build_model architectures.
+    """
+    def __init__(self, weights_path):
+        with np.load(weights_path, allow_pickle=False) as data:
+            spec = json.loads(str(data['__spec__']))
+            layers = [dict(entry, **{key.split('_', 1)[1]: data[key] for key in entry['weights']}) for entry in spec]
+        self.mask_zero = bool(layers and layers[0].get('mask_zero'))
+        self.layers = self._fold(layers)
+
+    @staticmethod
+    def _fold(layers):
+        folded = []
+        pending = None
+        for layer in layers:
+            kind = layer['type']
+            if kind == 'Dropout':
+                continue
+            if kind == 'BatchNormalization':
+                scale = layer['gamma'] / np.sqrt(layer['moving_variance'] + layer['epsilon'])
+                shift = layer['beta'] - layer['moving_mean'] * scale
+                pending = (scale, shift) if pending is None else (pending[0] * scale, pending[1] * scale + shift)
+                continue
+            if pending is not None:
+                if kind not in ('Dense', 'LSTM'):
+                    raise ValueError(f"Cannot fold BatchNormalization into {kind}")
+                # (x * scale + shift) @ K + b == x @ (scale[:, None] * K) + (shift @ K + b)
+                scale, shift = pending
+                layer = dict(layer, kernel=scale[:, None] * layer['kernel'], bias=layer['bias'] + shift @ layer['kernel'])
+                pending = None
+            if kind == 'LSTM':
+                layer = dict(layer, stacked_kernel=np.vstack([layer['kernel'], layer['recurrent_kernel']]))
+            folded.append(layer)
+        if pending is not None:
+            folded.append({'type': 'Affine', 'scale': pending[0], 'shift': pending[1]})
+        return folded
+
+    @staticmethod
+    def _lstm(inputs, layer, mask=None):
+        batch_size, steps, _ = inputs.shape
+        units = layer['recurrent_kernel'].shape[0]
+        kernel, bias = layer['stacked_kernel'], layer['bias']
+        h = np.zeros((batch_size, units), dtype=np.float32)
+        c = np.zeros((batch_size, units), dtype=np.float32)
+        outputs = np.empty((batch_size, steps, units), dtype=np.float32) if layer['return_sequences'] else None
+        for t in range(steps):
+            z = np.concatenate([inputs[:, t, :], h], axis=1) @ kernel + bias
+            # keras gate order: input, forget, cell, output
+            i = _sigmoid(z[:, :units])
+            f = _sigmoid(z[:, units:2 * units])
+            g = np.tanh(z[:, 2 * units:3 * units])
+            o = _sigmoid(z[:, 3 * units:])
+            if mask is None:
+                c = f * c + i * g
+                h = o * np.tanh(c)
+            else:
+                # Masked steps carry the previous state (and output) forward, as in keras
+                step_mask = mask[:, t, np.newaxis]
+                c = np.where(step_mask, f * c + i * g, c)
+                h = np.where(step_mask, o * np.tanh(c), h)
+            if outputs is not None:
+                outputs[:, t, :] = h
+        return outputs if outputs is not None else h
+
+    @staticmethod
+    def _gru(inputs, layer, mask=None):
+        batch_size, steps, _ = inputs.shape
+        units = layer['recurrent_kernel'].shape[0]
+        # reset_after GRUs keep separate input and recurrent biases
+        input_bias, recurrent_bias = layer['bias']
+        projected = inputs @ layer['kernel'] + input_bias
+        h = np.zeros((batch_size, units), dtype=np.float32)
+        outputs = np.empty((batch_size, steps, units), dtype=np.float32) if layer['return_sequences'] else None
+        for t in range(steps):
+            x = projected[:, t, :]
+            r_h = h @ layer['recurrent_kernel'] + recurrent_bias
+            # keras gate order: update, reset, candidate
+            z = _sigmoid(x[:, :units] + r_h[:, :units])
+            r = _sigmoid(x[:, units:2 * units] + r_h[:, units:2 * units])
+            candidate = np.tanh(x[:, 2 * units:] + r * r_h[:, 2 * units:])
+            new_h = z * h + (1.0 - z) * candidate
+            h = new_h if mask is None else np.where(mask[:, t, np.newaxis], new_h, h)
+            if outputs is not None:
+                outputs[:, t, :] = h
+        return outputs if outputs is not None else h
+
+    @staticmethod
+    def _conv1d(inputs, layer):
+        kernel = layer['kernel']
+        width = kernel.shape[0]
+        if layer['padding'] == 'same':
+            left = (width - 1) // 2
+            inputs = np.pad(inputs, ((0, 0), (left, width - 1 - left), (0, 0)))
+        # (batch, steps, channels, width) windows -> one matmul against the flattened kernel
+        windows = np.lib.stride_tricks.sliding_window_view(inputs, width, axis=1)
+        windows = windows.transpose(0, 1, 3, 2).reshape(windows.shape[0], windows.shape[1], -1)
+        return NUMPY_ACTIVATIONS[layer['activation']](windows @ kernel.reshape(-1, kernel.shape[2]) + layer['bias'])
+
+    def predict_on_batch(self, padded_sequences):
+        x = np.asarray(padded_sequences)
+        mask = x != 0 if self.mask_zero else None
+        for layer in self.layers:
+            kind = layer['type']
+            if kind == 'Embedding':
+                x = layer['embeddings'][x]
+            elif kind in ('LSTM', 'GRU'):
+                x = (self._lstm if kind == 'LSTM' else self._gru)(x, layer, mask)
+                if x.ndim == 2:
+                    mask = None
+            elif kind == 'Conv1D':
+                x = self._conv1d(x, layer)
+            elif kind == 'GlobalMaxPooling1D':
+                x = x.max(axis=1)
+                mask = None
+            elif kind in ('GlobalAveragePooling1D', 'MaskedGlobalAveragePooling1D'):
+                if mask is None:
+                    x = x.mean(axis=1)
+                else:
+                    weights = mask[:, :, np.newaxis].astype(np.float32)
+                    x = (x * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1.0)
+                mask = None
+            elif kind == 'Dense':
+                x = NUMPY_ACTIVATIONS[layer['activation']](x @ layer['kernel'] + layer['bias'])
+            elif kind == 'Affine':
+                x = x * layer['scale'] + layer['shift']
+        return x
+
+# Multipliers for hashing token ids and id pairs into the feature space
+FEATURE_HASH_A = 2654435761
+FEATURE_HASH_B = 40503
+
+class HashedBagOfWordsClassifier:
+    """Linear first-stage model over hashed unigram and bigram token ids of the padded sequences.
+
+    Trained with SGD logistic regression; serving needs only NumPy and the saved weights.
+    """
+    def __init__(self, n_features=2 ** 18, coef=None, intercept=None):
+        self.n_features = n_features
+        self.coef = coef
+        self.intercept = intercept
+
+    def features(self, padded_sequences):
+        """(row, column, value) triples of the l2-normalized hashed feature matrix"""
+        X = np.asarray(padded_sequences, dtype=np.int64)
+        present = X != 0
+        unigram_rows, unigram_positions = np.nonzero(present)
+        unigrams = X[unigram_rows, unigram_positions] * FEATURE_HASH_A % self.n_features
+        bigram_rows, bigram_positions = np.nonzero(present[:, :-1] & present[:, 1:])
+        bigrams = (
+            X[bigram_rows, bigram_positions] * FEATURE_HASH_A
+            + X[bigram_rows, bigram_positions + 1] * FEATURE_HASH_B + 1
+        ) % self.n_features
+        rows = np.concatenate([unigram_rows, bigram_rows])
+        columns = np.concatenate([unigrams, bigrams])
+        counts = np.bincount(rows, minlength=len(X))
+        values = 1.0 / np.sqrt(np.maximum(counts[rows], 1))
+        return rows, columns, values.astype(np.float32)
+
+    def fit(self, labels, read_sequences, num_classes=3, epochs=3, chunk_rows=100000, seed=42):
+        """Run SGD over shuffled row chunks; read_sequences(rows) returns the padded sequences of sorted rows"""
+        sparse = lazy_import('scipy.sparse')
+        model = lazy_import('sklearn.linear_model').SGDClassifier(loss='log_loss', alpha=1e-6, random_state=seed)
+        labels = np.asarray(labels)
+        classes = np.arange(num_classes)
+        class_weights = balanced_class_weights(labels)
+        rng = np.random.default_rng(seed)
+        for epoch in range(epochs):
+            order = rng.permutation(len(labels))
+            for start in range(0, len(order), chunk_rows):
+                rows = np.sort(order[start:start + chunk_rows])
+                sequences = read_sequences(rows)
+                feature_rows, columns, values = self.features(sequences)
+                # coo -> csr sums repeated features, matching the bincount scoring in decision_function
+                matrix = sparse.csr_matrix((values, (feature_rows, columns)), shape=(len(rows), self.n_features))
+                y = labels[rows]
+                model.partial_fit(matrix, y, classes=classes, sample_weight=class_weights[y])
+        self.coef = model.coef_.T.astype(np.float32)
+        self.intercept = model.intercept_.astype(np.float32)
+        return self
+
+    def decision_function(self, padded_sequences):
+        rows, columns, values = self.features(padded_sequences)
+        scores = np.empty((len(padded_sequences), self.coef.shape[1]), dtype=np.float32)
+        for label in range(self.coef.shape[1]):
+            scores[:, label] = np.bincount(rows, weights=self.coef[columns, label] * values, minlength=len(padded_sequences))
+        return scores + self.intercept
+
+    def predict_on_batch(self, padded_sequences):
+        """One-vs-rest probabilities normalized per row, as SGDClassifier.predict_proba computes them"""
+        probabilities = _sigmoid(self.decision_function(padded_sequences))
+        return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+    def save(self, path):
+        np.savez(path, coef=self.coef, intercept=self.intercept, n_features=np.array(self.n_features))
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(int(data['n_features']), coef=data['coef'], intercept=data['intercept'])
+
+def predict_probabilities(model, padded_sequences, batch_size=1024):
+    """predict_bucketed over a large array in fixed-size slices"""
+    return np.concatenate([
+        predict_bucketed(model, padded_sequences[start:start + batch_size])
+        for start in range(0, len(padded_sequences), batch_size)
+    ])
+
+def cascade_predict(first_stage, threshold, model, padded_sequences):
+    """First-stage probabilities, replaced by the deep model's below the confidence threshold.
+
+    Returns the probabilities and the row indices the deep model handled.
+    """
+    probabilities = first_stage.predict_on_batch(padded_sequences)
+    deep_rows = np.nonzero(probabilities.max(axis=1) < threshold)[0]
+    if len(deep_rows):
+        probabilities[deep_rows] = predict_bucketed(model, padded_sequences[deep_rows])
+    return probabilities, deep_rows
+
+def evaluate_cascade(first_probabilities, deep_probabilities, y, threshold):
+    """Traffic split and accuracy of the cascade at one threshold, against the deep model alone"""
+    routed = first_probabilities.max(axis=1) >= threshold
+    first_labels = first_probabilities.argmax(axis=1)
+    deep_labels = deep_probabilities.argmax(axis=1)
+    cascade_labels = np.where(routed, first_labels, deep_labels)
+    cascade_accuracy = float(np.mean(cascade_labels == y))
+    deep_accuracy = float(np.mean(deep_labels == y))
+    return {
+        'threshold': float(threshold),
+        'examples': int(len(y)),
+        'first_stage_share': float(np.mean(routed)),
+        'deep_share': float(1.0 - np.mean(routed)),
+        'first_stage_accuracy_on_share': float(np.mean(first_labels[routed] == y[routed])) if routed.any() else None,
+        'first_stage_accuracy': float(np.mean(first_labels == y)),
+        'cascade_accuracy': cascade_accuracy,
+        'deep_accuracy': deep_accuracy,
+        'accuracy_change': cascade_accuracy - deep_accuracy
+    }
+
+def tune_cascade_threshold(first_probabilities, deep_probabilities, y_val, max_accuracy_drop=0.005):
+    """Lowest confidence threshold whose validation accuracy stays within max_accuracy_drop of the deep model.
+
+    Returns None when no threshold lets the first stage take any traffic at that cost.
+    """
+    confidence = first_probabilities.max(axis=1)
+    deep_accuracy = float(np.mean(deep_probabilities.argmax(axis=1) == y_val))
+    # Every lower threshold routes a superset of the texts, so scan from the most permissive
+    for threshold in np.unique(np.quantile(confidence, np.linspace(0, 1, 201))):
+        report = evaluate_cascade(first_probabilities, deep_probabilities, y_val, threshold)
+        if report['first_stage_share'] > 0 and report['cascade_accuracy'] >= deep_accuracy - max_accuracy_drop:
+            return float(threshold)
+    return None
+
+def report_cascade(classifier, version_dir, X_test, y_test):
+    """Measure the tuned cascade on the test split and save the report next to the bundle"""
+    first_probabilities = classifier.first_stage.predict_on_batch(X_test)
+    deep_probabilities = predict_probabilities(classifier.model, X_test)
+    report = evaluate_cascade(first_probabilities, deep_probabilities, y_test, classifier.cascade_threshold)
+    with open(os.path.join(version_dir, 'cascade_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(
+        f"cascade: first stage handles {report['first_stage_share']:.1%} of test texts at threshold {report['threshold']:.3f}, "
+        f"accuracy {report['cascade_accuracy']:.4f} vs deep model {report['deep_accuracy']:.4f} ({report['accuracy_change']:+.4f})"
+    )
+    return report
+
+def train_cascade(classifier, y_train, read_train_sequences, X_val, y_val, max_accuracy_drop=0.005):
+    """Fit the first stage on the training split and tune its threshold on the validation split"""
+    print("Training first-stage classifier...")
+    first_stage = HashedBagOfWordsClassifier().fit(y_train, read_train_sequences)
+    first_probabilities = first_stage.predict_on_batch(X_val)
+    deep_probabilities = predict_probabilities(classifier.model, X_val)
+    threshold = tune_cascade_threshold(first_probabilities, deep_probabilities, y_val, max_accuracy_drop)
+    if threshold is None:
+        print("First stage cannot take traffic within the accuracy budget; serving the deep model alone")
+        return None
+    report = evaluate_cascade(first_probabilities, deep_probabilities, y_val, threshold)
+    print(
+        f"Cascade threshold {threshold:.3f}: first stage handles {report['first_stage_share']:.1%} of validation texts, "
+        f"accuracy change {report['accuracy_change']:+.4f}"
+    )
+    classifier.first_stage = first_stage
+    classifier.cascade_threshold = threshold
+    return report
+_worker_normalizer = None
+
+def _init_clean_worker():
+    """Build the lemmatizer and stopword tables once per worker process"""
+    global _worker_normalizer
+    lemmatizer = None
+    try:
+        lemmatizer = lazy_import('nltk.stem').WordNetLemmatizer()
+    except Exception as e:
+        print(f"Warning: Could not initialize lemmatizer: {e}")
+    _worker_normalizer = TextNormalizer(lemmatizer)
+
+def _clean_chunk(texts):
+    return [_worker_normalizer.normalize(text) for text in texts]
+
+def clean_texts_parallel(texts, num_workers=None, chunk_size=2000):
+    """Clean texts on a process pool, returning them in the original order"""
+    texts = list(texts)
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers == 1 or len(texts) <= chunk_size:
+        _init_clean_worker()
+        return _clean_chunk(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    print(f"Cleaning {len(texts)} texts in {len(chunks)} chunks on {num_workers} workers...")
+    cleaned = []
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=pool_context(),
+        initializer=_init_clean_worker
+    ) as pool:
+        # map yields chunk results in submission order
+        for chunk_result in pool.map(_clean_chunk, chunks):
+            cleaned.extend(chunk_result)
+    return cleaned
+
+def raw_text_key(text):
+    """sha256 hex of the raw text, the same value Spark's sha2(col, 256) produces; None for missing texts.
+
+    Missing values (None, NaN) are never cached: they always clean to '', and
+    hashing str(text) would collide with the literal strings 'None' and 'nan'.
+    """
+    if not isinstance(text, str):
+        return None
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def clean_cache_partition(cache_dir, normalizer_key):
+    # Each normalizer configuration is its own partition, so any change starts from empty
+    return os.path.join(cache_dir, f'normalizer={normalizer_key}')
+
+class CleanTextCache:
+    """On-disk Parquet cache of cleaned text keyed by raw-text hash and TextNormalizer.cache_key()"""
+    def __init__(self, cache_dir, normalizer):
+        self.cache_dir = cache_dir
+        self.normalizer_key = normalizer.cache_key()
+        self.partition_dir = clean_cache_partition(cache_dir, self.normalizer_key)
+        self.entries = {}
+        if os.path.isdir(self.partition_dir):
+            table = lazy_import('pandas').read_parquet(self.partition_dir, columns=['text_hash', 'clean_text'])
+            self.entries = dict(zip(table['text_hash'], table['clean_text']))
+
+    def clean(self, texts, num_workers=None, chunk_size=2000):
+        """Return cleaned texts in order, cleaning and persisting only rows not cached yet"""
+        keys = [raw_text_key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key is not None and key not in self.entries and key not in missing:
+                missing[key] = text
+        print(f"Clean-text cache: {len(keys) - len(missing)} of {len(keys)} rows cached, cleaning {len(missing)}")
+        if missing:
+            cleaned = clean_texts_parallel(list(missing.values()), num_workers=num_workers, chunk_size=chunk_size)
+            new_entries = dict(zip(missing, cleaned))
+            self._append(new_entries)
+            self.entries.update(new_entries)
+        return ['' if key is None else self.entries[key] for key in keys]
+
+    def _append(self, new_entries):
+        pd = lazy_import('pandas')
+        os.makedirs(self.partition_dir, exist_ok=True)
+        # A new part file per run; earlier parts are never rewritten
+        part_path = os.path.join(self.partition_dir, f'part-{int(time.time() * 1000)}-{os.getpid()}.parquet')
+        pd.DataFrame({'text_hash': list(new_entries), 'clean_text': list(new_entries.values())}).to_parquet(part_path, index=False)
+
+# Same defaults as keras Tokenizer, so distributed encoding matches texts_to_sequences
+KERAS_FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+KERAS_FILTER_TABLE = str.maketrans({c: ' ' for c in KERAS_FILTERS})
+
+def keras_words(text):
+    """Split text into words exactly like keras text_to_word_sequence"""
+    return [word for word in text.lower().translate(KERAS_FILTER_TABLE).split(' ') if word]
+
+def encode_text(text, word_index, num_words, max_len, oov_index=1):
+    """Encode one text like texts_to_sequences + post-padded pad_sequences"""
+    sequence = []
+    for word in keras_words(text):
+        index = word_index.get(word)
+        if index is None or index >= num_words:
+            index = oov_index
+        sequence.append(index)
+        if len(sequence) == max_len:
+            break
+    return sequence + [0] * (max_len - len(sequence))
+
+def apply_vocabulary(tokenizer, vocabulary):
+    """Load a ranked [(word, count)] vocabulary into a WordIndexTokenizer or keras Tokenizer"""
+    if isinstance(tokenizer, WordIndexTokenizer):
+        tokenizer.set_vocabulary(vocabulary)
+        return tokenizer
+    tokenizer.word_counts = OrderedDict(vocabulary)
+    ranked_words = [word for word, _ in vocabulary]
+    if tokenizer.oov_token is not None:
+        ranked_words = [tokenizer.oov_token] + ranked_words
+    tokenizer.word_index = dict(zip(ranked_words, range(1, len(ranked_words) + 1)))
+    tokenizer.index_word = {index: word for word, index in tokenizer.word_index.items()}
+    return tokenizer
+
+def _clean_series(texts, expected_settings=None):
+    if _worker_normalizer is None:
+        _init_clean_worker()
+    if expected_settings is not None and _worker_normalizer.settings() != expected_settings:
+        # An executor without the NLTK corpora would mix differently cleaned rows into the training data
+        raise RuntimeError(
+            f"Text normalizer on this executor has settings {_worker_normalizer.settings()}, "
+            f"the driver has {expected_settings}; install the NLTK corpora on every executor"
+        )
+    return texts.map(_worker_normalizer.normalize)
+
+def build_vocabulary_spark(texts_rdd, num_words):
+    """Distributed word count ranked like keras Tokenizer: count desc, then first occurrence"""
+    def partition_counts(rows):
+        stats = {}
+        for text, row_index in rows:
+            for position, word in enumerate(keras_words(text or '')):
+                entry = stats.get(word)
+                if entry is None:
+                    stats[word] = [1, (row_index, position)]
+                else:
+                    entry[0] += 1
+        return ((word, (count, first)) for word, (count, first) in stats.items())
+
+    counts = texts_rdd.zipWithIndex() \
+        .mapPartitions(partition_counts) \
+        .reduceByKey(lambda a, b: (a[0] + b[0], min(a[1], b[1])))
+    # Words ranked past num_words always encode to OOV, so only the head is collected
+    top = counts.takeOrdered(num_words, key=lambda item: (-item[1][0], item[1][1]))
+    return [(word, count) for word, (count, _) in top]
+
+def _clean_with_cache_spark(df, clean_udf, cache_dir, normalizer_key):
+    """Clean only rows whose raw-text hash is not in the Parquet cache, then append them to it"""
+    functions = lazy_import('pyspark.sql.functions')
+    partition_dir = clean_cache_partition(cache_dir, normalizer_key)
+    keyed = df.select(
+        # Row ids keep the original order through the join, so vocabulary ties and splits are unchanged
+        functions.monotonically_increasing_id().alias('row_id'),
+        functions.sha2(functions.col('Text').cast('string'), 256).alias('text_hash'),
+        functions.col('Text'),
+        # Convert labels from [-1, 0, 1] to [0, 1, 2]
+        (functions.col('Label') + 1).cast('int').alias('label')
+    )
+    if os.path.isdir(partition_dir):
+        cached = df.sparkSession.read.parquet(partition_dir).dropDuplicates(['text_hash'])
+        keyed = keyed.join(cached.select('text_hash', functions.col('clean_text').alias('cached_text')), 'text_hash', 'left')
+    else:
+        keyed = keyed.withColumn('cached_text', functions.lit(None).cast('string'))
+    hits = keyed.where(functions.col('cached_text').isNotNull()).select(
+        'row_id', 'text_hash', functions.col('cached_text').alias('clean_text'), 'label', functions.lit(True).alias('from_cache')
+    )
+    misses = keyed.where(functions.col('cached_text').isNull()).select(
+        'row_id', 'text_hash', clean_udf(functions.col('Text')).alias('clean_text'), 'label', functions.lit(False).alias('from_cache')
+    )
+    cleaned = hits.unionByName(misses).orderBy('row_id').persist()
+    new_rows = cleaned.where(~functions.col('from_cache'))
+    new_count = new_rows.count()
+    print(f"Clean-text cache: cleaned {new_count} of {cleaned.count()} rows")
+    if new_count:
+        # Null texts hash to null and are cleaned every time, like raw_text_key's missing values
+        new_rows.where(functions.col('text_hash').isNotNull()).select('text_hash', 'clean_text').dropDuplicates(['text_hash']) \
+            .write.mode('append').parquet(partition_dir)
+    return cleaned.select('clean_text', 'label'), cleaned
+
+def _encode_dataframe_spark(classifier, df, clean_cache_dir=None, fit_vocabulary=True):
+    """Clean and encode on the executors; returns the encoded frame and a release callback"""
+    functions = lazy_import('pyspark.sql.functions')
+    types = lazy_import('pyspark.sql.types')
+    spark = df.sparkSession
+    spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+    # Executors need this module to unpickle the UDFs
+    spark.sparkContext.addPyFile(os.path.abspath(__file__))
+
+    print("Cleaning texts on executors...")
+    normalizer_settings = classifier.normalizer.settings()
+
+    def clean_series(texts):
+        return _clean_series(texts, normalizer_settings)
+
+    clean_udf = functions.pandas_udf(clean_series, types.StringType())
+    if clean_cache_dir:
+        cleaned, persisted = _clean_with_cache_spark(df, clean_udf, clean_cache_dir, classifier.normalizer.cache_key())
+    else:
+        cleaned = persisted = df.select(
+            clean_udf(functions.col('Text')).alias('clean_text'),
+            # Convert labels from [-1, 0, 1] to [0, 1, 2]
+            (functions.col('Label') + 1).cast('int').alias('label')
+        ).persist()
+
+    if fit_vocabulary:
+        print("Building vocabulary...")
+        vocabulary = build_vocabulary_spark(cleaned.select('clean_text').rdd.map(lambda row: row[0]), classifier.max_words)
+        apply_vocabulary(classifier.tokenizer, vocabulary)
+    num_words = classifier.max_words
+    max_len = classifier.max_len
+    word_index = {word: index for word, index in classifier.tokenizer.word_index.items() if index < num_words}
+    word_index_broadcast = spark.sparkContext.broadcast(word_index)
+
+    print("Encoding sequences on executors...")
+    def encode_series(texts):
+        index = word_index_broadcast.value
+        return texts.map(lambda text: encode_text(text or '', index, num_words, max_len))
+
+    encode_udf = functions.pandas_udf(encode_series, types.ArrayType(types.IntegerType()))
+    encoded = cleaned.select(encode_udf(functions.col('clean_text')).alias('sequence'), 'label')
+
+    def release():
+        persisted.unpersist()
+        word_index_broadcast.unpersist()
+
+    return encoded, release
+
+def prepare_data_spark(classifier, df, output_path=None, clean_cache_dir=None):
+    """Clean and encode on the executors, collecting only the int sequence matrix"""
+    encoded, release = _encode_dataframe_spark(classifier, df, clean_cache_dir)
+    if output_path:
+        encoded.write.mode('overwrite').parquet(output_path)
+        encoded = encoded.sparkSession.read.parquet(output_path)
+
+    pdf = encoded.toPandas()
+    release()
+    if len(pdf) == 0:
+        return np.zeros((0, classifier.max_len), dtype=np.int32), np.zeros((0,), dtype=np.int64)
+    padded_sequences = np.stack(pdf['sequence'].values).astype(np.int32)
+    return padded_sequences, pdf['label'].values
+
+def prepare_shards_spark(classifier, df, shard_dir, rows_per_shard=100000, clean_cache_dir=None, fit_vocabulary=True):
+    """Clean and encode on the executors, streaming rows into .npy shards one partition at a time"""
+    encoded, release = _encode_dataframe_spark(classifier, df, clean_cache_dir, fit_vocabulary)
+    writer = SequenceShardWriter(shard_dir, classifier.max_len, rows_per_shard)
+    sequences, labels = [], []
+    try:
+        # toLocalIterator holds one partition on the driver instead of the whole corpus
+        for row in encoded.toLocalIterator(prefetchPartitions=True):
+            sequences.append(row['sequence'])
+            labels.append(row['label'])
+            if len(labels) == SHARD_CHUNK_ROWS:
+                writer.append(np.array(sequences, dtype=np.int32), labels)
+                sequences, labels = [], []
+        if labels:
+            writer.append(np.array(sequences, dtype=np.int32), labels)
+    finally:
+        release()
+    print(f"Wrote {writer.close()} rows to {writer.shard_count} shards in {shard_dir}")
+    return load_shard_labels(shard_dir)
+
 def remove_nan_duplicates(df):
     """Remove NaN values and duplicates from a Spark DataFrame."""
     df = df.dropna() 
     return df
-def create_kafka_consumer(bootstrap_servers, topic):
+def create_kafka_consumer(bootstrap_servers, topic, group_id=None, auto_offset_reset='latest'):
     """Create and return a Kafka consumer"""
-    return KafkaConsumer(
+    return lazy_import('kafka').KafkaConsumer(
         topic,
         bootstrap_servers=bootstrap_servers,
-        value_deserializer=lambda x: x.decode('utf-8'),
-        auto_offset_reset='latest',
+        group_id=group_id,
+        # Values stay bytes here; decode_message_values decodes them so the time shows up in the metrics
+        auto_offset_reset=auto_offset_reset,
         enable_auto_commit=True
     )
 
-def create_mongo_connection(uri, db_name, collection_name):
+def create_mongo_connection(uri, db_name, collection_name, max_pool_size=100, write_concern=1):
     """Create and return MongoDB client, database, and collection"""
-    client = MongoClient(uri)
+    client = lazy_import('pymongo').MongoClient(uri, maxPoolSize=max_pool_size, w=write_concern)
     db = client[db_name]
     collection = db[collection_name]
     return client, collection
-def get_sentiment(text,classifier): 
-    # Preprocess the text
-    preprocessed_text = classifier.clean_text(text)
-    
-    # Convert to sequence and pad
-    sequence = classifier.tokenizer.texts_to_sequences([preprocessed_text])
-    padded_sequence = pad_sequences(
-        sequence, 
-        maxlen=classifier.max_len, 
-        padding='post', 
-        truncating='post'
-    )
-    
-    # Make prediction
-    prediction = classifier.model.predict(padded_sequence)
-    predicted_label = np.argmax(prediction, axis=1)[0]
-    
-    # Convert numerical label to sentiment
-    sentiment_map = {0: 'Negative', 1: 'Neutral', 2: 'Positive'}
-    sentiment = sentiment_map[predicted_label]
+SENTIMENT_MAP = {0: 'Negative', 1: 'Neutral', 2: 'Positive'}
+
+def encode_texts(preprocessed_texts, classifier):
+    """Convert cleaned texts to one post-padded batch matrix"""
+    if hasattr(classifier.tokenizer, 'encode'):
+        return classifier.tokenizer.encode(preprocessed_texts, classifier.max_len)
+    sequences = classifier.tokenizer.texts_to_sequences(preprocessed_texts)
+    # Same result as pad_sequences(padding='post', truncating='post') without importing TensorFlow
+    padded_sequences = np.zeros((len(sequences), classifier.max_len), dtype=np.int32)
+    for row, sequence in enumerate(sequences):
+        sequence = sequence[:classifier.max_len]
+        padded_sequences[row, :len(sequence)] = sequence
+    return padded_sequences
+def predict_sentiments(padded_sequences, preprocessed_texts, classifier, metrics=None):
+    """Run one forward pass over an encoded batch and map the outputs to results"""
+    if classifier.first_stage is not None:
+        predictions, deep_rows = cascade_predict(classifier.first_stage, classifier.cascade_threshold, classifier.model, padded_sequences)
+        if metrics is not None:
+            metrics.record_cascade(len(padded_sequences) - len(deep_rows), len(deep_rows))
+    else:
+        # predict_on_batch skips the per-call setup of model.predict's loop
+        predictions = predict_bucketed(classifier.model, padded_sequences)
+    predicted_labels = np.argmax(predictions, axis=1)
     
+    return [
+        {
+            'sentiment': SENTIMENT_MAP[int(label)],
+            'confidence': float(prediction[label]),
+            'preprocessed_text': preprocessed_text
+        }
+        for prediction, label, preprocessed_text in zip(predictions, predicted_labels, preprocessed_texts)
+    ]
+class ResultCache:
+    """Bounded LRU cache of analysis results keyed by a hash of the raw text and the model version"""
+    def __init__(self, max_entries=100000, ttl_seconds=3600, model_version=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.model_version = model_version or ''
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, text):
+        return hashlib.blake2b(f"{self.model_version}\0{text}".encode('utf-8'), digest_size=16).digest()
+
+    def get(self, text):
+        key = self._key(text)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, text, result):
+        key = self._key(text)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate, 'entries': len(self._entries)}
+LATENCY_BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+METRIC_STAGES = ('decode', 'clean', 'tokenize', 'predict', 'mongo_write')
+
+class Histogram:
+    """Fixed-bucket histogram with the cumulative layout of the Prometheus exposition format"""
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Prometheus buckets are "less than or equal to" the bound
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (the largest bound for overflow)"""
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return self.bounds[-1]
+
+    def cumulative(self):
+        running = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            running += count
+            yield bound, running
+
+class StreamingMetrics:
+    """Stage latency histograms plus throughput, batch size, cache hit rate and consumer lag"""
+    def __init__(self, cache=None, lag_interval_s=10):
+        self.cache = cache
+        self.lag_interval_s = lag_interval_s
+        self.started = time.monotonic()
+        self.stage_latency = {stage: Histogram(LATENCY_BUCKETS_MS) for stage in METRIC_STAGES}
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.messages = 0
+        self.cascade_messages = {'first_stage': 0, 'deep': 0}
+        self.consumer_lag = {}
+        self._last_lag_sample = 0.0
+        self._last_log = (self.started, 0)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._reporter = None
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, (time.perf_counter() - started) * 1000)
+
+    def observe(self, stage, elapsed_ms):
+        with self._lock:
+            self.stage_latency[stage].observe(elapsed_ms)
+
+    def record_batch(self, batch_len):
+        with self._lock:
+            self.messages += batch_len
+            self.batch_sizes.observe(batch_len)
+
+    def record_cascade(self, first_stage_count, deep_count):
+        with self._lock:
+            self.cascade_messages['first_stage'] += first_stage_count
+            self.cascade_messages['deep'] += deep_count
+
+    def maybe_sample_lag(self, consumer):
+        """Refresh per-partition lag at most every lag_interval_s; call from the polling thread"""
+        now = time.monotonic()
+        if now - self._last_lag_sample < self.lag_interval_s or not hasattr(consumer, 'end_offsets'):
+            return
+        self._last_lag_sample = now
+        try:
+            partitions = list(consumer.assignment())
+            end_offsets = consumer.end_offsets(partitions) if partitions else {}
+            lag = {
+                f"{partition.topic}-{partition.partition}": max(0, end_offsets[partition] - consumer.position(partition))
+                for partition in partitions
+            }
+        except Exception as e:
+            # Lag is best effort and must never stop consumption
+            print(f"Warning: could not sample consumer lag: {e}")
+            return
+        with self._lock:
+            self.consumer_lag = lag
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            uptime_s = now - self.started
+            snapshot = {
+                'uptime_s': round(uptime_s, 1),
+                'messages': self.messages,
+                'messages_per_s': round(self.messages / uptime_s, 1) if uptime_s else 0.0,
+                'batches': self.batch_sizes.count,
+                'mean_batch_size': round(self.batch_sizes.total / self.batch_sizes.count, 1) if self.batch_sizes.count else 0.0,
+                'stages': {
+                    stage: {
+                        'count': histogram.count,
+                        'mean_ms': round(histogram.total / histogram.count, 3) if histogram.count else None,
+                        'p50_ms': histogram.quantile(0.5),
+                        'p99_ms': histogram.quantile(0.99)
+                    }
+                    for stage, histogram in self.stage_latency.items()
+                },
+                'consumer_lag': dict(self.consumer_lag)
+            }
+            cascaded = sum(self.cascade_messages.values())
+            if cascaded:
+                snapshot['cascade_first_stage_share'] = round(self.cascade_messages['first_stage'] / cascaded, 4)
+        if self.cache is not None:
+            snapshot['cache_hit_rate'] = round(self.cache.hit_rate, 4)
+        return snapshot
+
+    def render_prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            lines.append('# HELP sentanaly_stage_latency_seconds Processing time per batch and stage')
+            lines.append('# TYPE sentanaly_stage_latency_seconds histogram')
+            for stage, histogram in self.stage_latency.items():
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound / 1000.0)
+                    lines.append(f'sentanaly_stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+                lines.append(f'sentanaly_stage_latency_seconds_sum{{stage="{stage}"}} {histogram.total / 1000.0}')
+                lines.append(f'sentanaly_stage_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines.append('# HELP sentanaly_batch_size Messages per processed batch')
+            lines.append('# TYPE sentanaly_batch_size histogram')
+            for bound, count in self.batch_sizes.cumulative():
+                le = '+Inf' if bound == float('inf') else str(bound)
+                lines.append(f'sentanaly_batch_size_bucket{{le="{le}"}} {count}')
+            lines.append(f'sentanaly_batch_size_sum {self.batch_sizes.total}')
+            lines.append(f'sentanaly_batch_size_count {self.batch_sizes.count}')
+            lines.append('# HELP sentanaly_messages_total Messages processed')
+            lines.append('# TYPE sentanaly_messages_total counter')
+            lines.append(f'sentanaly_messages_total {self.messages}')
+            if sum(self.cascade_messages.values()):
+                lines.append('# HELP sentanaly_cascade_messages_total Messages answered by each cascade stage')
+                lines.append('# TYPE sentanaly_cascade_messages_total counter')
+                for stage, count in self.cascade_messages.items():
+                    lines.append(f'sentanaly_cascade_messages_total{{stage="{stage}"}} {count}')
+            lines.append('# HELP sentanaly_consumer_lag Kafka consumer lag per partition')
+            lines.append('# TYPE sentanaly_consumer_lag gauge')
+            for partition, lag in sorted(self.consumer_lag.items()):
+                lines.append(f'sentanaly_consumer_lag{{partition="{partition}"}} {lag}')
+        if self.cache is not None:
+            lines.append('# HELP sentanaly_cache_hit_ratio Result cache hit ratio')
+            lines.append('# TYPE sentanaly_cache_hit_ratio gauge')
+            lines.append(f'sentanaly_cache_hit_ratio {self.cache.hit_rate}')
+        return '\n'.join(lines) + '\n'
+
+    def log_snapshot(self):
+        """Print the snapshot as one structured line, with the throughput since the previous line"""
+        snapshot = self.snapshot()
+        now = time.monotonic()
+        last_time, last_messages = self._last_log
+        snapshot['recent_messages_per_s'] = round((snapshot['messages'] - last_messages) / (now - last_time), 1) if now > last_time else 0.0
+        self._last_log = (now, snapshot['messages'])
+        print(f"metrics {json.dumps(snapshot, sort_keys=True)}")
+
+    def start_log_reporter(self, interval_s):
+        """Log a metrics line every interval_s seconds"""
+        def report_periodically():
+            while not self._closed.wait(interval_s):
+                self.log_snapshot()
+        self._reporter = threading.Thread(target=report_periodically, name='metrics-reporter', daemon=True)
+        self._reporter.start()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._reporter is not None:
+            self._reporter.join()
+        self.log_snapshot()
+
+def start_metrics_server(metrics, port, host='127.0.0.1'):
+    """Serve metrics.render_prometheus() at http://host:port/metrics from a daemon thread"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes every few seconds would otherwise flood the log
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+def stage_timer(metrics, stage):
+    return metrics.timer(stage) if metrics is not None else contextlib.nullcontext()
+
+def decode_message_values(messages):
+    """Kafka record values as text (the consumer hands over raw bytes)"""
+    return [value.decode('utf-8') if isinstance(value, bytes) else value for value in (message.value for message in messages)]
+
+def _analyze_texts(texts, classifier, metrics=None):
+    with stage_timer(metrics, 'clean'):
+        preprocessed_texts = [classifier.clean_text(text) for text in texts]
+    with stage_timer(metrics, 'tokenize'):
+        padded_sequences = encode_texts(preprocessed_texts, classifier)
+    with stage_timer(metrics, 'predict'):
+        return predict_sentiments(padded_sequences, preprocessed_texts, classifier, metrics)
+def get_sentiments(texts, classifier, cache=None, metrics=None):
+    """Analyze a batch of texts with a single forward pass over the padded batch"""
+    if cache is None:
+        return _analyze_texts(texts, classifier, metrics)
+    # Cache hits skip cleaning and inference entirely
+    results = [cache.get(text) for text in texts]
+    missed_texts = list(dict.fromkeys(text for text, result in zip(texts, results) if result is None))
+    if missed_texts:
+        computed = dict(zip(missed_texts, _analyze_texts(missed_texts, classifier, metrics)))
+        for text, result in computed.items():
+            cache.put(text, result)
+        results = [computed[text] if result is None else result for text, result in zip(texts, results)]
+    return results
+def get_sentiment(text,classifier): 
+    return get_sentiments([text], classifier)[0]
+def build_result_document(original_text, analysis_results):
+    """Build the MongoDB document for one analyzed text"""
     return {
-        'sentiment': sentiment,
-        'confidence': float(prediction[0][predicted_label]),
-        'preprocessed_text': preprocessed_text
-    }
-def save_to_mongodb(collection, original_text, analysis_results):
-    """Save the original text and analysis results to MongoDB"""
-    document = {
         'original_text': original_text,
         'sentiment': analysis_results['sentiment'],
         'confidence': analysis_results['confidence'],
         'preprocessed_text': analysis_results['preprocessed_text'],
-        'timestamp': datetime.utcnow()
+        'timestamp': datetime.datetime.utcnow()
     }
-    
-    return collection.insert_one(document)
-def process_messages(consumer, mongo_collection, classifier): 
+class BulkMongoWriter:
+    """Buffer result documents and write them with unordered insert_many.
+
+    Full batches of batch_size documents are handed to a flusher thread
+    through a queue of at most max_pending_batches, so add() only blocks
+    when MongoDB falls that far behind. The flusher also writes the partial
+    buffer when flush_interval_ms has passed since the last flush, and
+    close() writes whatever is left.
+    """
+    def __init__(self, collection, batch_size=500, flush_interval_ms=1000, max_retries=3, retry_backoff_ms=200, metrics=None, max_pending_batches=4):
+        self.collection = collection
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.flush_interval_ms = flush_interval_ms
+        self.max_retries = max_retries
+        self.retry_backoff_ms = retry_backoff_ms
+        self.written = 0
+        self.failed = 0
+        self._buffer = []
+        self._pending = queue.Queue(maxsize=max_pending_batches)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        # Time-based flushing must also happen while no new documents arrive
+        self._flusher = threading.Thread(target=self._flush_periodically, name='mongo-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def add(self, document):
+        with self._lock:
+            self._buffer.append(document)
+            if len(self._buffer) < self.batch_size:
+                return
+            documents, self._buffer = self._buffer, []
+        if self._closed.is_set():
+            # No flusher thread any more
+            self._write(documents)
+        else:
+            self._pending.put(documents)
+
+    def add_result(self, original_text, analysis_results):
+        self.add(build_result_document(original_text, analysis_results))
+
+    def _flush_periodically(self):
+        interval = self.flush_interval_ms / 1000.0
+        next_flush = time.monotonic() + interval
+        while not self._closed.is_set():
+            try:
+                documents = self._pending.get(timeout=max(0.0, next_flush - time.monotonic()))
+            except queue.Empty:
+                documents = None
+            try:
+                if documents:
+                    self._write(documents)
+                elif time.monotonic() >= next_flush:
+                    self.flush()
+                    next_flush = time.monotonic() + interval
+            except Exception as e:
+                print(f"Error flushing results to MongoDB: {e}")
+
+    def _write(self, documents):
+        with self._flush_lock:
+            self._write_batches([documents])
+
+    def _write_batches(self, batches):
+        for i, documents in enumerate(batches):
+            if not documents:
+                continue
+            try:
+                with stage_timer(self.metrics, 'mongo_write'):
+                    self._insert(documents)
+            except Exception:
+                # Non-transient error: keep this batch and the ones after it for the next flush
+                with self._lock:
+                    self._buffer = [document for batch in batches[i:] if batch for document in batch] + self._buffer
+                raise
+
+    def flush(self):
+        """Write queued batches and the partial buffer now"""
+        with self._flush_lock:
+            batches = []
+            while True:
+                try:
+                    batches.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock:
+                batches.append(self._buffer)
+                self._buffer = []
+            self._write_batches(batches)
+
+    def _insert(self, documents):
+        errors = lazy_import('pymongo.errors')
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.collection.insert_many(documents, ordered=False)
+                self.written += len(documents)
+                return
+            except errors.BulkWriteError as e:
+                # insert_many assigned _id client-side, so duplicates here are
+                # documents that already landed during an earlier attempt
+                write_errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+                self.written += len(documents) - len(write_errors)
+                self.failed += len(write_errors)
+                if write_errors:
+                    print(f"Warning: {len(write_errors)} documents rejected by MongoDB: {write_errors[0].get('errmsg')}")
+                return
+            except (errors.AutoReconnect, errors.ConnectionFailure) as e:
+                if attempt == self.max_retries:
+                    self.failed += len(documents)
+                    print(f"Error writing {len(documents)} documents to MongoDB after {attempt + 1} attempts: {e}")
+                    return
+                time.sleep(self.retry_backoff_ms * (2 ** attempt) / 1000.0)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        # Wake the flusher if it is waiting on an empty queue; flush() skips the marker
+        try:
+            self._pending.put_nowait(None)
+        except queue.Full:
+            pass
+        self._flusher.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+# Per executor Python worker: loaded classifiers and Mongo clients, reused across tasks and micro-batches
+_executor_cache = {}
+
+def broadcast_bundle(spark_context, bundle_dir=DEFAULT_BUNDLE_DIR, version=None, backend='numpy'):
+    """Broadcast the files one bundle version needs for the given backend"""
+    version = version or resolve_bundle_version(bundle_dir)
+    version_dir = os.path.join(bundle_dir, version)
+    # load_bundle reads vocabulary.txt when present and only falls back to tokenizer.json
+    tokenizer_name = 'vocabulary.txt' if os.path.exists(os.path.join(version_dir, 'vocabulary.txt')) else 'tokenizer.json'
+    names = ['config.json', BUNDLE_BACKEND_ARTIFACTS[backend], tokenizer_name, 'first_stage.npz']
+    files = {}
+    for name in names:
+        path = os.path.join(version_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                files[name] = f.read()
+    print(f"Broadcasting bundle {version} ({sum(map(len, files.values())) / 1e6:.1f} MB) for the {backend} backend")
+    return spark_context.broadcast({'version': version, 'files': files})
+
+def executor_classifier(bundle_broadcast, backend='numpy', cascade=False):
+    """Write a broadcast bundle to local disk and load it once per executor Python worker"""
+    bundle = bundle_broadcast.value
+    key = ('classifier', bundle['version'], backend, cascade)
+    if key not in _executor_cache:
+        bundle_dir = tempfile.mkdtemp(prefix='sentanaly-bundle-')
+        version_dir = os.path.join(bundle_dir, bundle['version'])
+        os.makedirs(version_dir)
+        for name, content in bundle['files'].items():
+            with open(os.path.join(version_dir, name), 'wb') as f:
+                f.write(content)
+        _executor_cache[key] = RedditSentimentClassifier.load_bundle(bundle_dir, bundle['version'], backend=backend, cascade=cascade)
+    return _executor_cache[key]
+
+SCORE_COLUMNS = ('sentiment', 'confidence', 'preprocessed_text')
+
+def score_schema_fields():
+    """Spark fields matching the columns score_text_series returns"""
+    types = lazy_import('pyspark.sql.types')
+    return [
+        types.StructField('sentiment', types.StringType()),
+        types.StructField('confidence', types.DoubleType()),
+        types.StructField('preprocessed_text', types.StringType())
+    ]
+
+def score_text_series(texts, classifier):
+    """Score a pandas Series of raw texts in one batch, as a frame of SCORE_COLUMNS"""
+    pd = lazy_import('pandas')
+    texts = texts.fillna('').astype(str).tolist()
+    results = get_sentiments(texts, classifier) if texts else []
+    return pd.DataFrame(results, columns=list(SCORE_COLUMNS))
+
+def executor_mongo_collection(uri, db_name, collection_name, write_concern=1):
+    key = ('mongo', uri, db_name, collection_name, write_concern)
+    if key not in _executor_cache:
+        _executor_cache[key] = create_mongo_connection(uri, db_name, collection_name, write_concern=write_concern)
+    return _executor_cache[key][1]
+
+def write_partition_to_mongo(rows, uri, db_name, collection_name, batch_size=500, write_concern=1):
+    """Bulk-insert scored rows keyed by message_id; raise if any are rejected so Spark retries the task"""
+    writer = BulkMongoWriter(executor_mongo_collection(uri, db_name, collection_name, write_concern), batch_size=batch_size)
+    try:
+        for row in rows:
+            document = build_result_document(row['text'], {column: row[column] for column in SCORE_COLUMNS})
+            # A stable _id turns replays of a micro-batch into duplicate-key no-ops
+            document['_id'] = row['message_id']
+            writer.add(document)
+    finally:
+        writer.close()
+    if writer.failed:
+        raise RuntimeError(f"{writer.failed} documents could not be written to MongoDB")
+    return writer.written
+class AdaptiveBatchSizer:
+    """Adjust the micro-batch size so one batch stays under a latency target"""
+    def __init__(self, initial_size=32, min_size=1, max_size=512, target_latency_ms=250):
+        self.batch_size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency_ms = target_latency_ms
+
+    def update(self, batch_len, elapsed_ms):
+        if elapsed_ms > self.target_latency_ms:
+            # Too slow: shrink proportionally to the overshoot
+            scaled = int(self.batch_size * self.target_latency_ms / elapsed_ms)
+            self.batch_size = max(self.min_size, scaled)
+        elif batch_len >= self.batch_size and elapsed_ms < 0.8 * self.target_latency_ms:
+            # Full batch with headroom left: grow gradually
+            self.batch_size = min(self.max_size, self.batch_size + max(1, self.batch_size // 4))
+        return self.batch_size
+def poll_batch(consumer, max_records, max_wait_ms):
+    """Collect up to max_records messages, waiting at most max_wait_ms"""
+    messages = []
+    deadline = time.monotonic() + max_wait_ms / 1000.0
+    while len(messages) < max_records:
+        remaining_ms = int((deadline - time.monotonic()) * 1000)
+        if remaining_ms <= 0:
+            break
+        records = consumer.poll(timeout_ms=remaining_ms, max_records=max_records - len(messages))
+        for partition_messages in records.values():
+            messages.extend(partition_messages)
+    return messages
+def process_messages(consumer, writer, classifier, max_batch_size=512, max_wait_ms=100, target_latency_ms=250, cache=None, stop_event=None, metrics=None, log_messages=False): 
     print("Starting to process messages...")
+    sizer = AdaptiveBatchSizer(max_size=max_batch_size, target_latency_ms=target_latency_ms)
     try:
-        for message in consumer:
-            text = message.value
-            print(f"Received message: {text}")
+        # Runs until stop_event is set, or forever without one
+        while stop_event is None or not stop_event.is_set():
+            messages = poll_batch(consumer, sizer.batch_size, max_wait_ms)
+            if metrics is not None:
+                metrics.maybe_sample_lag(consumer)
+            if not messages:
+                continue
+            started = time.perf_counter()
+            with stage_timer(metrics, 'decode'):
+                texts = decode_message_values(messages)
+            if log_messages:
+                for text in texts:
+                    print(f"Received message: {text}")
             
-            # Analyze sentiment
-            analysis_results = get_sentiment(text, classifier)
+            # Analyze sentiment for the whole batch at once
+            batch_results = get_sentiments(texts, classifier, cache=cache, metrics=metrics)
             
-            # Save to MongoDB
-            save_to_mongodb(mongo_collection, text, analysis_results)
+            # Buffer for the bulk MongoDB writer
+            for text, analysis_results in zip(texts, batch_results):
+                writer.add_result(text, analysis_results)
+                if log_messages:
+                    print(f"Processed and saved message. Sentiment: {analysis_results['sentiment']}")
             
-            print(f"Processed and saved message. Sentiment: {analysis_results['sentiment']}")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            sizer.update(len(messages), elapsed_ms)
+            if metrics is not None:
+                metrics.record_batch(len(messages))
             
     except Exception as e:
         print(f"Error processing messages: {str(e)}")
         raise e    
-def build_the_model(classifier):
-    print("Initializing Spark session...")
-    spark = SparkSession.builder \
-        .appName("RedditSentimentAnalysis") \
-        .getOrCreate()
+_STAGE_DONE = object()
+
+class StreamingPipeline:
+    """Consume, preprocess, infer and persist in overlapping stages.
+
+    A Kafka polling thread, preprocess_workers cleaning/tokenizing threads
+    (cleaning itself runs on a process pool) and one inference thread are
+    linked by bounded queues, so a slow stage blocks the ones before it and
+    polling stops when the queues are full. The poll size comes from an
+    AdaptiveBatchSizer fed with the time each batch spends being processed
+    (not waiting in queues), as in the serial consumer. Results
+    go to the asynchronous BulkMongoWriter. stop() lets every stage drain
+    its in-flight batches before run() returns.
+    """
+    def __init__(self, consumer, writer, classifier, preprocess_workers=2, queue_size=4, max_batch_size=512, max_wait_ms=100, target_latency_ms=250, cache=None, metrics=None, log_messages=False):
+        self.consumer = consumer
+        self.log_messages = log_messages
+        self.metrics = metrics
+        self.cache = cache
+        self.writer = writer
+        self.classifier = classifier
+        self.preprocess_workers = preprocess_workers
+        self.max_wait_ms = max_wait_ms
+        self.sizer = AdaptiveBatchSizer(max_size=max_batch_size, target_latency_ms=target_latency_ms)
+        self.raw_queue = queue.Queue(maxsize=queue_size)
+        self.encoded_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.abort_event = threading.Event()
+        self.errors = []
+        self.clean_pool = None
+
+    def stop(self, *args):
+        self.stop_event.set()
+
+    def _put(self, stage_queue, item):
+        while not self.abort_event.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, stage_queue):
+        while not self.abort_event.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _guarded(self, stage):
+        def run_stage():
+            try:
+                stage()
+            except Exception as e:
+                print(f"Error in pipeline stage {threading.current_thread().name}: {e}")
+                self.errors.append(e)
+                self.abort_event.set()
+        return run_stage
+
+    def _consume(self):
+        while not self.stop_event.is_set():
+            messages = poll_batch(self.consumer, self.sizer.batch_size, self.max_wait_ms)
+            if self.metrics is not None:
+                self.metrics.maybe_sample_lag(self.consumer)
+            if not messages:
+                continue
+            with stage_timer(self.metrics, 'decode'):
+                texts = decode_message_values(messages)
+            if self.log_messages:
+                for text in texts:
+                    print(f"Received message: {text}")
+            if self.metrics is not None:
+                # Counted when polled, so cache hits that never reach inference are included
+                self.metrics.record_batch(len(texts))
+            if not self._put(self.raw_queue, texts):
+                return
+        for _ in range(self.preprocess_workers):
+            self._put(self.raw_queue, _STAGE_DONE)
+
+    def _preprocess(self):
+        while True:
+            texts = self._get(self.raw_queue)
+            if texts is None:
+                return
+            if texts is _STAGE_DONE:
+                break
+            polled = len(texts)
+            started = time.perf_counter()
+            if self.cache is not None:
+                texts = self._write_cached(texts)
+                if not texts:
+                    continue
+            with stage_timer(self.metrics, 'clean'):
+                preprocessed_texts = self.clean_pool.submit(_clean_chunk, texts).result()
+            with stage_timer(self.metrics, 'tokenize'):
+                padded_sequences = encode_texts(preprocessed_texts, self.classifier)
+            busy_ms = (time.perf_counter() - started) * 1000
+            if not self._put(self.encoded_queue, (texts, preprocessed_texts, padded_sequences, polled, busy_ms)):
+                return
+        self._put(self.encoded_queue, _STAGE_DONE)
+
+    def _write_cached(self, texts):
+        """Write cache hits straight to the writer and return the texts still to analyze"""
+        missed_texts = []
+        for text in texts:
+            cached = self.cache.get(text)
+            if cached is None:
+                missed_texts.append(text)
+            else:
+                self._save_result(text, cached)
+        return missed_texts
+
+    def _save_result(self, text, analysis_results):
+        self.writer.add_result(text, analysis_results)
+        if self.log_messages:
+            print(f"Processed and saved message. Sentiment: {analysis_results['sentiment']}")
+
+    def _infer(self):
+        remaining_workers = self.preprocess_workers
+        while remaining_workers:
+            item = self._get(self.encoded_queue)
+            if item is None:
+                return
+            if item is _STAGE_DONE:
+                remaining_workers -= 1
+                continue
+            texts, preprocessed_texts, padded_sequences, polled, busy_ms = item
+            started = time.perf_counter()
+            with stage_timer(self.metrics, 'predict'):
+                batch_results = predict_sentiments(padded_sequences, preprocessed_texts, self.classifier, self.metrics)
+            for text, analysis_results in zip(texts, batch_results):
+                if self.cache is not None:
+                    self.cache.put(text, analysis_results)
+                self._save_result(text, analysis_results)
+            # Queue waits are left out: under backlog they would shrink batches and cut throughput further
+            self.sizer.update(polled, busy_ms + (time.perf_counter() - started) * 1000)
+
+    def run(self):
+        print("Starting pipelined message processing...")
+        self.clean_pool = ProcessPoolExecutor(
+            max_workers=self.preprocess_workers,
+            mp_context=pool_context(),
+            initializer=_init_clean_worker
+        )
+        # Start the worker processes before any pipeline thread exists
+        list(self.clean_pool.map(_clean_chunk, [[]] * self.preprocess_workers))
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
 
+        threads = [threading.Thread(target=self._guarded(self._consume), name='kafka-consumer')]
+        threads += [
+            threading.Thread(target=self._guarded(self._preprocess), name=f'preprocess-{i}')
+            for i in range(self.preprocess_workers)
+        ]
+        threads.append(threading.Thread(target=self._guarded(self._infer), name='inference'))
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    try:
+                        thread.join(timeout=0.5)
+                    except KeyboardInterrupt:
+                        print("Stopping: draining in-flight messages...")
+                        self.stop()
+        finally:
+            self.clean_pool.shutdown()
+            self.writer.flush()
+        if self.errors:
+            raise self.errors[0]
+def load_training_data(spark):
     print("Loading data...")
     # Read CSV file using Spark
     df1 = spark.read.csv('Reddit_Data.csv', header=True, inferSchema=True)
     df2 = spark.read.csv('Twitter_Data.csv', header=True, inferSchema=True)
     df = df1.union(df2)
-    df=remove_nan_duplicates(df)
+    return remove_nan_duplicates(df)
+def build_the_model(classifier, preprocess_workers=None, preprocess_chunk_size=2000, distributed_preprocessing=True, bundle_dir=DEFAULT_BUNDLE_DIR, tflite_quantization='dynamic', shard_dir=None, shard_rows=100000, clean_cache_dir=None, architecture='lstm', cascade=False, cascade_max_accuracy_drop=0.005):
+    print("Initializing Spark session...")
+    spark = lazy_import('pyspark.sql').SparkSession.builder \
+        .appName("RedditSentimentAnalysis") \
+        .getOrCreate()
+
+    df = load_training_data(spark)
     print("Initializing classifier...")
     
     
-    X, y = classifier.prepare_data(df)
-    
-    print("Splitting data...")
-    X_train, X_temp, y_train, y_temp = train_test_split(X, y, test_size=0.3, random_state=42)
-    X_val, X_test, y_val, y_test = train_test_split(X_temp, y_temp, test_size=0.5, random_state=42)
-    
-    print("Building and training model...")
-    classifier.build_model()
-    history = classifier.train(
-        X_train,
-        y_train,
-        X_val,
-        y_val,
-        epochs=15,
-        batch_size=64
-    )
-    
-    print("Evaluating model on test data...")
-    test_loss, test_accuracy = classifier.model.evaluate(X_test, y_test, batch_size=64)
+    if shard_dir:
+        # Out-of-core: rows go straight to disk shards and the split is by row index
+        if distributed_preprocessing:
+            labels = prepare_shards_spark(classifier, df, shard_dir, rows_per_shard=shard_rows, clean_cache_dir=clean_cache_dir)
+        else:
+            labels = classifier.prepare_shards(df, shard_dir, num_workers=preprocess_workers, chunk_size=preprocess_chunk_size, rows_per_shard=shard_rows, clean_cache_dir=clean_cache_dir)
+        
+        print("Splitting data...")
+        train_indices, val_indices, test_indices = split_indices(len(labels))
+        
+        print("Building and training model...")
+        classifier.build_model(architecture=architecture)
+        history = classifier.train_on_shards(shard_dir, train_indices, val_indices, epochs=15, batch_size=64)
+        
+        print("Evaluating model on test data...")
+        test_loss, test_accuracy = classifier.model.evaluate(
+            make_shard_dataset(shard_dir, 64, indices=test_indices, bucket=masks_padding(classifier.model))
+        )
+        # Only the test split is materialized, for the backend parity reports
+        X_test, y_test = read_shard_rows(shard_dir, test_indices)
+        calibration_data = read_shard_rows(shard_dir, train_indices[:TFLITE_CALIBRATION_ROWS])[0]
+        if cascade:
+            X_val, y_val = read_shard_rows(shard_dir, val_indices)
+            train_cascade(
+                classifier,
+                labels[train_indices],
+                lambda rows: read_shard_rows(shard_dir, train_indices[rows])[0],
+                X_val,
+                y_val,
+                cascade_max_accuracy_drop
+            )
+    else:
+        if distributed_preprocessing:
+            X, y = prepare_data_spark(classifier, df, clean_cache_dir=clean_cache_dir)
+        else:
+            X, y = classifier.prepare_data(df, num_workers=preprocess_workers, chunk_size=preprocess_chunk_size, clean_cache_dir=clean_cache_dir)
+        
+        print("Splitting data...")
+        train_test_split = lazy_import('sklearn.model_selection').train_test_split
+        X_train, X_temp, y_train, y_temp = train_test_split(X, y, test_size=0.3, random_state=42)
+        X_val, X_test, y_val, y_test = train_test_split(X_temp, y_temp, test_size=0.5, random_state=42)
+        
+        print("Building and training model...")
+        classifier.build_model(architecture=architecture)
+        history = classifier.train(
+            X_train,
+            y_train,
+            X_val,
+            y_val,
+            epochs=15,
+            batch_size=64
+        )
+        
+        print("Evaluating model on test data...")
+        test_loss, test_accuracy = classifier.model.evaluate(X_test, y_test, batch_size=64)
+        calibration_data = X_train[:TFLITE_CALIBRATION_ROWS]
+        if cascade:
+            train_cascade(classifier, y_train, lambda rows: X_train[rows], X_val, y_val, cascade_max_accuracy_drop)
     print(f"Test Loss: {test_loss:.4f}, Test Accuracy: {test_accuracy:.4f}")
+    version_dir = classifier.save_bundle(bundle_dir, tflite_quantization=tflite_quantization, representative_data=calibration_data)
+    if tflite_quantization:
+        report_backend_parity(classifier, version_dir, 'tflite', X_test, y_test)
+    report_backend_parity(classifier, version_dir, 'numpy', X_test, y_test)
+    if classifier.first_stage is not None:
+        report_cascade(classifier, version_dir, X_test, y_test)
  
      
     spark.stop()
-start=True
-def main(): 
+# The configuration build_the_model trains, always included as the first search trial
+BASELINE_TRIAL = {
+    'max_words': 50000,
+    'max_len': 200,
+    'embedding_dim': 200,
+    'architecture': 'lstm',
+    'lstm_units': (256, 128),
+    'batch_size': 64,
+    'learning_rate': 0.001
+}
+SEARCH_SPACE = {
+    'max_words': [20000, 50000],
+    'max_len': [100, 200],
+    'embedding_dim': [64, 200],
+    'architecture': list(ARCHITECTURES),
+    'lstm_units': [(64,), (128,), (256, 128)],
+    'batch_size': [64, 256],
+    'learning_rate': [0.001, 0.003]
+}
+
+def search_trials(space=SEARCH_SPACE, max_trials=16, seed=42):
+    """The baseline plus a seeded random sample of the remaining grid points"""
+    keys = sorted(space)
+    grid = []
+    for values in itertools.product(*(space[key] for key in keys)):
+        trial = dict(zip(keys, values))
+        # lstm_units only shapes LSTM models; collapse it elsewhere so each model is trained once
+        if trial['architecture'] != 'lstm':
+            trial['lstm_units'] = ()
+        if trial not in grid:
+            grid.append(trial)
+    others = [trial for trial in grid if trial != BASELINE_TRIAL]
+    if len(others) > max_trials - 1:
+        others = random.Random(seed).sample(others, max_trials - 1)
+    return [dict(BASELINE_TRIAL)] + others
+
+def cap_sequences(padded_sequences, max_words, max_len, oov_index=1):
+    """Re-encode sequences prepared with a larger vocabulary and length for a smaller trial.
+
+    The vocabulary ranking does not depend on num_words, so this is exactly what
+    encoding with num_words=max_words and maxlen=max_len would have produced.
+    """
+    capped = np.array(padded_sequences[:, :max_len], dtype=np.int32)
+    capped[capped >= max_words] = oov_index
+    return capped
+
+def median_batch_ms(predict, batch, repeats=10):
+    """Median wall time of predict(batch) in milliseconds, after one warm-up call"""
+    predict(batch)
+    timings_ms = []
+    for _ in range(repeats):
+        batch_started = time.perf_counter()
+        predict(batch)
+        timings_ms.append((time.perf_counter() - batch_started) * 1000)
+    return round(float(np.median(timings_ms)), 2)
+
+def run_search_trial(trial, shard_dir, split, epochs=15, latency_batch_size=256):
+    """Train one configuration with early stopping and measure accuracy, latency and size"""
+    started = time.perf_counter()
+    try:
+        data = {}
+        for name, indices in zip(('train', 'val', 'test'), split):
+            X, y = read_shard_rows(shard_dir, indices)
+            data[name] = (cap_sequences(X, trial['max_words'], trial['max_len']), y)
+        classifier = RedditSentimentClassifier(
+            max_words=trial['max_words'],
+            max_len=trial['max_len'],
+            embedding_dim=trial['embedding_dim']
+        )
+        classifier.build_model(
+            lstm_units=tuple(trial['lstm_units']),
+            learning_rate=trial['learning_rate'],
+            architecture=trial['architecture']
+        )
+        # Trials share a working directory, so no checkpoint file
+        fit_started = time.perf_counter()
+        history = classifier.train(*data['train'], *data['val'], epochs=epochs, batch_size=trial['batch_size'], checkpoint_path=None, verbose=2)
+        fit_seconds = time.perf_counter() - fit_started
+        X_test, y_test = data['test']
+        test_loss, test_accuracy = classifier.model.evaluate(X_test, y_test, batch_size=256, verbose=0)
+        batch = X_test[:latency_batch_size]
+        ms_per_batch = median_batch_ms(lambda rows: predict_bucketed(classifier.model, rows), batch)
+        with tempfile.TemporaryDirectory() as model_dir:
+            model_path = os.path.join(model_dir, 'model.keras')
+            classifier.model.save(model_path)
+            model_bytes = os.path.getsize(model_path)
+            numpy_model = NumpyLSTMModel(export_numpy_weights(classifier.model, os.path.join(model_dir, 'numpy_weights.npz')))
+        numpy_ms_per_batch = median_batch_ms(lambda rows: predict_bucketed(numpy_model, rows), batch)
+        return dict(
+            trial,
+            lstm_units=list(trial['lstm_units']),
+            test_accuracy=float(test_accuracy),
+            test_loss=float(test_loss),
+            best_val_accuracy=float(max(history.history['val_accuracy'])),
+            epochs_run=len(history.history['loss']),
+            train_seconds=round(time.perf_counter() - started, 1),
+            seconds_per_epoch=round(fit_seconds / len(history.history['loss']), 2),
+            ms_per_batch=ms_per_batch,
+            numpy_ms_per_batch=numpy_ms_per_batch,
+            params=int(classifier.model.count_params()),
+            model_bytes=model_bytes
+        )
+    except Exception as e:
+        return dict(trial, lstm_units=list(trial['lstm_units']), error=f"{type(e).__name__}: {e}")
+
+def rank_search_results(results, min_accuracy):
+    """Cheapest (latency, then size) trials meeting min_accuracy first, then the rest by accuracy"""
+    completed = [result for result in results if 'error' not in result]
+    meeting = sorted(
+        (result for result in completed if result['test_accuracy'] >= min_accuracy),
+        key=lambda result: (result['ms_per_batch'], result['model_bytes'])
+    )
+    missing = sorted(
+        (result for result in completed if result['test_accuracy'] < min_accuracy),
+        key=lambda result: -result['test_accuracy']
+    )
+    return meeting + missing
+
+def print_search_table(ranked, min_accuracy):
+    print(f"{'rank':>4} {'ok':>2} {'test_acc':>8} {'ms/batch':>9} {'size_mb':>8} {'epochs':>6}  configuration")
+    for rank, result in enumerate(ranked, 1):
+        configuration = ', '.join(f"{key}={result[key]}" for key in sorted(BASELINE_TRIAL))
+        print(
+            f"{rank:>4} {'*' if result['test_accuracy'] >= min_accuracy else '':>2} {result['test_accuracy']:>8.4f} "
+            f"{result['ms_per_batch']:>9.2f} {result['model_bytes'] / 1e6:>8.1f} {result['epochs_run']:>6}  {configuration}"
+        )
+
+def search_hyperparameters(config):
+    """Train search trials in parallel on the Spark executors and rank them"""
+    print("Initializing Spark session...")
+    spark = lazy_import('pyspark.sql').SparkSession.builder \
+        .appName("RedditSentimentSearch") \
+        .getOrCreate()
+    sc = spark.sparkContext
+    trials = search_trials(max_trials=config['search_max_trials'])
+    # One shared dataset, encoded with the largest vocabulary and length any trial uses
     classifier = RedditSentimentClassifier(
-        max_words=50000,
-        max_len=200,
-        embedding_dim=200
+        max_words=max(trial['max_words'] for trial in trials),
+        max_len=max(trial['max_len'] for trial in trials),
+        embedding_dim=BASELINE_TRIAL['embedding_dim']
     )
-    global start
-    config = {
-        'kafka_bootstrap_servers': ['localhost:9092'],
-        'kafka_topic': 'text_analysis',
-        'mongo_uri': 'mongodb://localhost:27017/',
-        'mongo_db': 'sentiment_analysis',
-        'mongo_collection': 'results'
+    df = load_training_data(spark)
+    labels = prepare_shards_spark(classifier, df, config['shard_dir'], rows_per_shard=config['shard_rows'], clean_cache_dir=config['clean_cache_dir'])
+    split = split_indices(len(labels))
+
+    # Ship the shards to every executor; trials find their copy through SparkFiles
+    shard_dir = os.path.abspath(config['shard_dir'])
+    shard_name = os.path.basename(shard_dir)
+    sc.addFile(shard_dir, recursive=True)
+    sc.addPyFile(os.path.abspath(__file__))
+    split_broadcast = sc.broadcast(split)
+    epochs = config['search_epochs']
+
+    def run_on_executor(trial):
+        return run_search_trial(trial, lazy_import('pyspark').SparkFiles.get(shard_name), split_broadcast.value, epochs=epochs)
+
+    print(f"Running {len(trials)} search trials on the executors...")
+    results = sc.parallelize(trials, numSlices=len(trials)).map(run_on_executor).collect()
+    split_broadcast.unpersist()
+    spark.stop()
+
+    for result in results:
+        if 'error' in result:
+            print(f"Trial failed: {result['error']}")
+    ranked = rank_search_results(results, config['search_min_accuracy'])
+    print_search_table(ranked, config['search_min_accuracy'])
+    print("ms/batch is measured on the executors while other trials run; compare it between trials, not against serving")
+    with open(config['search_output'], 'w', encoding='utf-8') as f:
+        json.dump({'min_accuracy': config['search_min_accuracy'], 'ranked': ranked, 'results': results}, f, indent=2)
+    print(f"Wrote search results to {config['search_output']}")
+    return ranked
+
+def compare_architectures(config):
+    """Train every build_model architecture on the same split and report speed against accuracy"""
+    print("Initializing Spark session...")
+    spark = lazy_import('pyspark.sql').SparkSession.builder \
+        .appName("RedditSentimentArchitectures") \
+        .getOrCreate()
+    classifier = RedditSentimentClassifier(
+        max_words=BASELINE_TRIAL['max_words'],
+        max_len=BASELINE_TRIAL['max_len'],
+        embedding_dim=BASELINE_TRIAL['embedding_dim']
+    )
+    df = load_training_data(spark)
+    labels = prepare_shards_spark(classifier, df, config['shard_dir'], rows_per_shard=config['shard_rows'], clean_cache_dir=config['clean_cache_dir'])
+    spark.stop()
+    split = split_indices(len(labels))
+
+    # Sequential on the driver, so the timings are not skewed by other training runs
+    results = []
+    for architecture in ARCHITECTURES:
+        print(f"Training the {architecture} model...")
+        trial = dict(BASELINE_TRIAL, architecture=architecture)
+        if architecture != 'lstm':
+            trial['lstm_units'] = ()
+        result = run_search_trial(trial, config['shard_dir'], split, epochs=config['search_epochs'])
+        if 'error' in result:
+            print(f"{architecture} failed: {result['error']}")
+        results.append(result)
+
+    completed = [result for result in results if 'error' not in result]
+    print(f"{'model':>6} {'test_acc':>8} {'s/epoch':>8} {'epochs':>6} {'keras_ms':>9} {'numpy_ms':>9} {'params':>10} {'size_mb':>8}")
+    for result in completed:
+        print(
+            f"{result['architecture']:>6} {result['test_accuracy']:>8.4f} {result['seconds_per_epoch']:>8.1f} {result['epochs_run']:>6} "
+            f"{result['ms_per_batch']:>9.2f} {result['numpy_ms_per_batch']:>9.2f} {result['params']:>10} {result['model_bytes'] / 1e6:>8.1f}"
+        )
+    print("keras_ms/numpy_ms: median time to predict one 256-row test batch")
+    with open(config['architecture_report'], 'w', encoding='utf-8') as f:
+        json.dump({'environment': {'cpu_count': os.cpu_count(), 'platform': platform.platform()}, 'results': results}, f, indent=2)
+    print(f"Wrote architecture report to {config['architecture_report']}")
+    return results
+
+def collect_unlabeled_texts(bootstrap_servers, topic, group_id, max_messages, max_wait_s):
+    """Read up to max_messages distinct texts from the topic under their own consumer group"""
+    # A separate group from the serving consumers, starting from the oldest retained message
+    consumer = create_kafka_consumer(bootstrap_servers, topic, group_id=group_id, auto_offset_reset='earliest')
+    texts = []
+    deadline = time.monotonic() + max_wait_s
+    try:
+        while len(texts) < max_messages and time.monotonic() < deadline:
+            texts.extend(decode_message_values(poll_batch(consumer, min(500, max_messages - len(texts)), 1000)))
+    finally:
+        consumer.close()
+    return list(dict.fromkeys(texts))
+
+def distillation_targets(teacher_probabilities, labels=None, temperature=1.0, label_weight=0.0):
+    """Teacher probabilities softened by temperature, optionally mixed with one-hot labels"""
+    # p ** (1 / T) renormalized is softmax(logits / T)
+    targets = np.power(teacher_probabilities, 1.0 / temperature)
+    targets /= targets.sum(axis=1, keepdims=True)
+    if labels is not None and label_weight:
+        targets = (1.0 - label_weight) * targets + label_weight * np.eye(targets.shape[1], dtype=np.float32)[np.asarray(labels)]
+    return targets.astype(np.float32)
+
+def distill_model(config):
+    """Train a compact student on the saved teacher's outputs and save it as a servable bundle"""
+    teacher = RedditSentimentClassifier.load_bundle(config['bundle_dir'], config['bundle_version'], cascade=False)
+    print("Initializing Spark session...")
+    spark = lazy_import('pyspark.sql').SparkSession.builder \
+        .appName("RedditSentimentDistillation") \
+        .getOrCreate()
+    df = load_training_data(spark)
+    # Encode with the teacher's vocabulary, so its predictions are the ones it was trained for
+    labels = prepare_shards_spark(
+        teacher, df, config['distill_shard_dir'], rows_per_shard=config['shard_rows'],
+        clean_cache_dir=config['clean_cache_dir'], fit_vocabulary=False
+    )
+    spark.stop()
+    train_indices, val_indices, test_indices = split_indices(len(labels))
+    X_train, y_train = read_shard_rows(config['distill_shard_dir'], train_indices)
+    X_val, y_val = read_shard_rows(config['distill_shard_dir'], val_indices)
+    X_test, y_test = read_shard_rows(config['distill_shard_dir'], test_indices)
+
+    X_unlabeled = np.zeros((0, teacher.max_len), dtype=np.int32)
+    if config['distill_unlabeled_messages']:
+        try:
+            texts = collect_unlabeled_texts(
+                config['kafka_bootstrap_servers'], config['kafka_topic'], config['distill_group_id'],
+                config['distill_unlabeled_messages'], config['distill_unlabeled_wait_s']
+            )
+            X_unlabeled = encode_texts(clean_texts_parallel(texts, num_workers=config['preprocess_workers']), teacher)
+            # Texts that clean down to nothing carry no signal
+            X_unlabeled = X_unlabeled[np.count_nonzero(X_unlabeled, axis=1) > 0]
+        except Exception as e:
+            print(f"Warning: could not read unlabeled texts from Kafka, distilling on the training split only: {e}")
+    print(f"Distilling on {len(X_train)} labeled and {len(X_unlabeled)} unlabeled texts...")
+
+    print("Computing teacher probabilities...")
+    soft_targets = distillation_targets(
+        predict_probabilities(teacher.model, X_train), y_train, config['distill_temperature'], config['distill_label_weight']
+    )
+    if len(X_unlabeled):
+        soft_targets = np.concatenate([
+            soft_targets,
+            distillation_targets(predict_probabilities(teacher.model, X_unlabeled), temperature=config['distill_temperature'])
+        ])
+    X_distill = np.concatenate([X_train, X_unlabeled])
+    del X_train, X_unlabeled
+
+    # The student keeps the teacher's word ranking with a smaller vocabulary cap
+    student = RedditSentimentClassifier(
+        max_words=config['student_max_words'],
+        max_len=teacher.max_len,
+        embedding_dim=config['student_embedding_dim'],
+        tokenizer=WordIndexTokenizer(teacher.tokenizer.word_index, config['student_max_words'], teacher.tokenizer.oov_token)
+    )
+    student.build_model(architecture=config['student_architecture'], units=config['student_units'])
+    X_distill = cap_sequences(X_distill, student.max_words, student.max_len)
+    student.distill(
+        X_distill,
+        soft_targets,
+        cap_sequences(X_val, student.max_words, student.max_len),
+        y_val,
+        epochs=config['distill_epochs']
+    )
+    X_student_test = cap_sequences(X_test, student.max_words, student.max_len)
+    version_dir = student.save_bundle(
+        config['student_bundle_dir'], tflite_quantization=config['tflite_quantization'], representative_data=X_distill[:TFLITE_CALIBRATION_ROWS]
+    )
+    report_backend_parity(student, version_dir, 'numpy', X_student_test, y_test)
+
+    teacher_labels = predict_probabilities(teacher.model, X_test).argmax(axis=1)
+    student_labels = predict_probabilities(student.model, X_student_test).argmax(axis=1)
+    report = {
+        'teacher_version': teacher.version,
+        'examples': int(len(y_test)),
+        'teacher_accuracy': float(np.mean(teacher_labels == y_test)),
+        'student_accuracy': float(np.mean(student_labels == y_test)),
+        'label_agreement': float(np.mean(teacher_labels == student_labels)),
+        'teacher_ms_per_batch': median_batch_ms(lambda rows: predict_bucketed(teacher.model, rows), X_test[:256]),
+        'student_ms_per_batch': median_batch_ms(lambda rows: predict_bucketed(student.model, rows), X_student_test[:256]),
+        'teacher_params': int(teacher.model.count_params()),
+        'student_params': int(student.model.count_params()),
+        'teacher_size_mb': os.path.getsize(os.path.join(config['bundle_dir'], teacher.version, 'model.keras')) / 1e6,
+        'student_size_mb': os.path.getsize(os.path.join(version_dir, 'model.keras')) / 1e6
     }
-    if start:
-        build_the_model(classifier)
-        start =False
+    with open(os.path.join(version_dir, 'distillation_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(
+        f"Student keeps {report['student_accuracy'] / report['teacher_accuracy']:.1%} of teacher accuracy "
+        f"({report['student_accuracy']:.4f} vs {report['teacher_accuracy']:.4f}) at "
+        f"{report['student_ms_per_batch'] / report['teacher_ms_per_batch']:.1%} of its latency and "
+        f"{report['student_params'] / report['teacher_params']:.1%} of its parameters"
+    )
+    print(f"Serve the student by setting bundle_dir to {config['student_bundle_dir']}")
+    return report
+def serve(classifier, config):
+    """Consume the Kafka topic and persist results until stopped"""
+    cache = None
+    consumer = None
+    writer = None
+    mongo_client = None
+    metrics = StreamingMetrics(lag_interval_s=config['metrics_lag_interval_s'])
+    metrics_server = None
     try:
+        if config['metrics_port']:
+            metrics_server = start_metrics_server(metrics, config['metrics_port'], config['metrics_host'])
+        if config['metrics_log_interval_s']:
+            metrics.start_log_reporter(config['metrics_log_interval_s'])
          
         consumer = create_kafka_consumer(
             config['kafka_bootstrap_servers'],
-            config['kafka_topic']
+            config['kafka_topic'],
+            group_id=config['kafka_group_id']
         )
         
          
         mongo_client, collection = create_mongo_connection(
             config['mongo_uri'],
             config['mongo_db'],
-            config['mongo_collection']
+            config['mongo_collection'],
+            max_pool_size=config['mongo_max_pool_size'],
+            write_concern=config['mongo_write_concern']
         )
+        writer = BulkMongoWriter(
+            collection,
+            batch_size=config['mongo_batch_size'],
+            flush_interval_ms=config['mongo_flush_interval_ms'],
+            metrics=metrics
+        )
+        if config['result_cache_size']:
+            cache = ResultCache(
+                max_entries=config['result_cache_size'],
+                ttl_seconds=config['result_cache_ttl_s'],
+                model_version=classifier.version
+            )
+            metrics.cache = cache
         
-        
-        process_messages(consumer, collection, classifier)
+        if config['pipelined']:
+            StreamingPipeline(
+                consumer,
+                writer,
+                classifier,
+                preprocess_workers=config['preprocess_workers'] or 2,
+                queue_size=config['pipeline_queue_size'],
+                max_batch_size=config['max_batch_size'],
+                max_wait_ms=config['max_wait_ms'],
+                target_latency_ms=config['target_latency_ms'],
+                cache=cache,
+                metrics=metrics,
+                log_messages=config['log_messages']
+            ).run()
+        else:
+            stop_event = threading.Event()
+            if threading.current_thread() is threading.main_thread():
+                # supervise_workers stops workers with SIGTERM; finish the current batch so finally can flush it
+                signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+            process_messages(
+                consumer,
+                writer,
+                classifier,
+                max_batch_size=config['max_batch_size'],
+                max_wait_ms=config['max_wait_ms'],
+                target_latency_ms=config['target_latency_ms'],
+                cache=cache,
+                stop_event=stop_event,
+                metrics=metrics,
+                log_messages=config['log_messages']
+            )
         
     except Exception as e:
         print(f"Error in main function: {str(e)}")
         raise e
     finally: 
-        consumer.close()
-        mongo_client.close()
+        if cache is not None:
+            print(f"Result cache: {cache.stats()}")
+        # Setup may have failed part way, e.g. when the metrics port is taken
+        if writer is not None:
+            # Flush buffered results before the client goes away, and before
+            # closing the consumer commits the offsets of the messages behind them
+            writer.close()
+        if consumer is not None:
+            consumer.close()
+        if mongo_client is not None:
+            mongo_client.close()
+        metrics.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+def _serve_worker(config, worker_id):
+    """Entry point of one supervised consumer-group worker process"""
+    print(f"Worker {worker_id} (pid {os.getpid()}) loading model bundle...")
+    if config['metrics_port']:
+        # One scrape port per worker process
+        config = dict(config, metrics_port=config['metrics_port'] + worker_id)
+    classifier = RedditSentimentClassifier.load_bundle(
+        config['bundle_dir'], config['bundle_version'], backend=config['inference_backend'], cascade=config['cascade']
+    )
+    serve(classifier, config)
+def supervise_workers(config, num_workers):
+    """Run num_workers consumer processes in one Kafka consumer group, restarting any that crash.
+
+    Workers are spawned fresh and each loads the saved bundle (no retraining and no
+    TensorFlow state inherited across fork). Kafka rebalances the topic partitions
+    across the group whenever a worker joins or leaves.
+    """
+    context = multiprocessing.get_context('spawn')
+    stopping = threading.Event()
+    restart_backoff = [1.0] * num_workers
+    started_at = [0.0] * num_workers
+
+    def start_worker(worker_id):
+        process = context.Process(target=_serve_worker, args=(config, worker_id), name=f'sentiment-worker-{worker_id}')
+        process.start()
+        started_at[worker_id] = time.monotonic()
+        return process
+
+    def request_stop(*args):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    print(f"Starting {num_workers} workers in consumer group {config['kafka_group_id']}...")
+    workers = [start_worker(worker_id) for worker_id in range(num_workers)]
+    while not stopping.wait(1.0):
+        for worker_id, process in enumerate(workers):
+            if process.is_alive():
+                continue
+            if time.monotonic() - started_at[worker_id] > 60:
+                restart_backoff[worker_id] = 1.0
+            print(f"Worker {worker_id} exited with code {process.exitcode}, restarting in {restart_backoff[worker_id]:.0f}s")
+            if stopping.wait(restart_backoff[worker_id]):
+                break
+            # Back off on crash loops, up to a minute between restarts
+            restart_backoff[worker_id] = min(60.0, restart_backoff[worker_id] * 2)
+            workers[worker_id] = start_worker(worker_id)
+
+    print("Stopping workers...")
+    for process in workers:
+        if process.is_alive():
+            # SIGTERM lets each worker's pipeline drain before exiting
+            process.terminate()
+    for process in workers:
+        process.join()
+start=True
+def main(mode=None, download_nltk=False, num_workers=None, log_messages=False, serial=False, cascade=False): 
+    global start
+    config = {
+        'kafka_bootstrap_servers': ['localhost:9092'],
+        'kafka_topic': 'text_analysis',
+        'kafka_group_id': 'sentiment-analysis',
+        'mongo_uri': 'mongodb://localhost:27017/',
+        'mongo_db': 'sentiment_analysis',
+        'mongo_collection': 'results',
+        'mongo_max_pool_size': 100,
+        'mongo_write_concern': 1,
+        'mongo_batch_size': 500,
+        'mongo_flush_interval_ms': 1000,
+        'max_batch_size': 512,
+        'max_wait_ms': 100,
+        'target_latency_ms': 250,
+        # Overlap polling, preprocessing and inference; False runs them one after another
+        'pipelined': not serial,
+        'pipeline_queue_size': 4,
+        # Prometheus text endpoint (worker i of supervise mode uses metrics_port + i); None disables it
+        'metrics_port': 9108,
+        'metrics_host': '127.0.0.1',
+        # Structured "metrics {...}" log line interval; 0 disables it
+        'metrics_log_interval_s': 60,
+        'metrics_lag_interval_s': 10,
+        'log_messages': log_messages,
+        'search_max_trials': 16,
+        'search_epochs': 15,
+        # Accuracy bar for the search ranking; the cheapest trial above it ranks first
+        'search_min_accuracy': 0.85,
+        'search_output': 'search_results.json',
+        'architecture_report': 'architecture_report.json',
+        # Model trained by build_the_model, one of ARCHITECTURES
+        'architecture': 'lstm',
+        'result_cache_size': 100000,
+        'result_cache_ttl_s': 3600,
+        'preprocess_workers': None,
+        'preprocess_chunk_size': 2000,
+        'distributed_preprocessing': True,
+        'shard_dir': 'data_shards',
+        'shard_rows': 100000,
+        'clean_cache_dir': 'clean_cache',
+        'bundle_dir': DEFAULT_BUNDLE_DIR,
+        'bundle_version': None,
+        'tflite_quantization': 'dynamic',
+        'inference_backend': 'keras',
+        # Train a hashed bag-of-words first stage and serve it in front of the deep model (--cascade)
+        'cascade': cascade,
+        # Largest validation accuracy loss accepted when tuning the cascade threshold
+        'cascade_max_accuracy_drop': 0.005,
+        # Distillation: a small student trained on the bundle_dir teacher's outputs
+        'student_bundle_dir': 'student_bundle',
+        'student_architecture': 'cnn',
+        'student_units': 64,
+        'student_embedding_dim': 64,
+        'student_max_words': 20000,
+        'distill_shard_dir': 'distill_shards',
+        'distill_epochs': 15,
+        'distill_temperature': 1.0,
+        # Share of the one-hot label mixed into the teacher targets of labeled texts
+        'distill_label_weight': 0.3,
+        'distill_unlabeled_messages': 200000,
+        'distill_unlabeled_wait_s': 60,
+        'distill_group_id': 'sentiment-distillation',
+        'num_workers': num_workers or os.cpu_count() or 1
+    }
+    check_tflite_quantization(config['tflite_quantization'], config['student_architecture'] if mode == 'distill' else config['architecture'])
+    has_bundle = os.path.exists(os.path.join(config['bundle_dir'], 'LATEST'))
+    if mode is None:
+        # Serve straight from a saved bundle when there is one, otherwise train first
+        mode = 'serve' if has_bundle else 'train-and-serve'
+    trains = mode in ('train', 'train-and-serve', 'search', 'compare-architectures', 'distill') or (mode == 'supervise' and not has_bundle)
+    ensure_nltk_resources(download=download_nltk, required=trains)
+    if mode == 'search':
+        search_hyperparameters(config)
+        return
+    if mode == 'compare-architectures':
+        compare_architectures(config)
+        return
+    if mode == 'distill':
+        distill_model(config)
+        return
+    if mode == 'serve':
+        classifier = RedditSentimentClassifier.load_bundle(
+            config['bundle_dir'], config['bundle_version'], backend=config['inference_backend'], cascade=config['cascade']
+        )
+    elif mode == 'supervise' and has_bundle:
+        classifier = None
+    else:
+        classifier = RedditSentimentClassifier(
+            max_words=50000,
+            max_len=200,
+            embedding_dim=200
+        )
+        if start:
+            build_the_model(
+                classifier,
+                preprocess_workers=config['preprocess_workers'],
+                preprocess_chunk_size=config['preprocess_chunk_size'],
+                distributed_preprocessing=config['distributed_preprocessing'],
+                bundle_dir=config['bundle_dir'],
+                tflite_quantization=config['tflite_quantization'],
+                shard_dir=config['shard_dir'],
+                shard_rows=config['shard_rows'],
+                clean_cache_dir=config['clean_cache_dir'],
+                architecture=config['architecture'],
+                cascade=config['cascade'],
+                cascade_max_accuracy_drop=config['cascade_max_accuracy_drop']
+            )
+            start =False
+        if mode == 'train':
+            return
+    if mode == 'supervise':
+        supervise_workers(config, config['num_workers'])
+        return
+    print_startup_report()
+    serve(classifier, config)
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Reddit sentiment training and Kafka serving")
+    parser.add_argument(
+        '--mode',
+        choices=['train', 'serve', 'train-and-serve', 'supervise', 'search', 'compare-architectures', 'distill'],
+        help="default: serve if a model bundle exists, otherwise train-and-serve"
+    )
+    parser.add_argument(
+        '--download-nltk',
+        action='store_true',
+        help="download missing NLTK corpora instead of only checking the local cache"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help="number of consumer-group worker processes in supervise mode (default: CPU count)"
+    )
+    parser.add_argument(
+        '--log-messages',
+        action='store_true',
+        help="print every received message and its sentiment"
+    )
+    parser.add_argument(
+        '--serial',
+        action='store_true',
+        help="process one micro-batch at a time instead of the overlapping stage pipeline"
+    )
+    parser.add_argument(
+        '--cascade',
+        action='store_true',
+        help="train a bag-of-words first stage with the model, and answer confident texts with it when serving"
+    )
+    args = parser.parse_args()
+    main(args.mode, download_nltk=args.download_nltk, num_workers=args.workers, log_messages=args.log_messages, serial=args.serial, cascade=args.cascade)
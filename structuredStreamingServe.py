@@ -0,0 +1,125 @@
+import argparse
+import os
+import signal
+from mainCodeDLAndSparkAndPipline import (
+    DEFAULT_BUNDLE_DIR,
+    SCORE_COLUMNS,
+    broadcast_bundle,
+    ensure_nltk_resources,
+    executor_classifier,
+    lazy_import,
+    score_schema_fields,
+    score_text_series,
+    write_partition_to_mongo,
+)
+
+# Must match the installed PySpark version (requirements.txt pins 3.5.3)
+KAFKA_PACKAGE = 'org.apache.spark:spark-sql-kafka-0-10_2.12:3.5.3'
+
+def create_spark_session(args):
+    builder = lazy_import('pyspark.sql').SparkSession.builder \
+        .appName("RedditSentimentStructuredStreaming") \
+        .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+        .config("spark.sql.execution.arrow.maxRecordsPerBatch", str(args.udf_batch_size))
+    if args.kafka_package:
+        builder = builder.config("spark.jars.packages", args.kafka_package)
+    return builder.getOrCreate()
+
+def read_messages(spark, args):
+    """Kafka records as (message_id, text); message_id is topic-partition-offset, unique per record"""
+    functions = lazy_import('pyspark.sql.functions')
+    reader = spark.readStream \
+        .format('kafka') \
+        .option('kafka.bootstrap.servers', args.kafka_bootstrap_servers) \
+        .option('subscribe', args.kafka_topic) \
+        .option('startingOffsets', args.starting_offsets) \
+        .option('failOnDataLoss', 'false')
+    if args.max_offsets_per_trigger:
+        reader = reader.option('maxOffsetsPerTrigger', args.max_offsets_per_trigger)
+    if args.min_partitions:
+        # Split busy Kafka partitions into more Spark tasks
+        reader = reader.option('minPartitions', args.min_partitions)
+    return reader.load().select(
+        functions.concat_ws('-', 'topic', 'partition', 'offset').alias('message_id'),
+        functions.col('value').cast('string').alias('text')
+    )
+
+def score_messages(spark, messages, args):
+    """Add SCORE_COLUMNS with a pandas UDF that loads the broadcast bundle once per executor worker"""
+    functions = lazy_import('pyspark.sql.functions')
+    types = lazy_import('pyspark.sql.types')
+    # Executors import the pipeline module for the loader, scorer and Mongo writer
+    spark.sparkContext.addPyFile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mainCodeDLAndSparkAndPipline.py'))
+    bundle_broadcast = broadcast_bundle(spark.sparkContext, args.bundle_dir, args.bundle_version, backend=args.backend)
+    backend = args.backend
+    cascade = args.cascade
+
+    def score_series(texts):
+        return score_text_series(texts, executor_classifier(bundle_broadcast, backend, cascade))
+
+    score_udf = functions.pandas_udf(score_series, types.StructType(score_schema_fields()))
+    return messages.withColumn('result', score_udf(functions.col('text'))).select(
+        'message_id', 'text', *[f'result.{column}' for column in SCORE_COLUMNS]
+    )
+
+def run(args):
+    ensure_nltk_resources(download=args.download_nltk)
+    print("Initializing Spark session...")
+    spark = create_spark_session(args)
+    scored = score_messages(spark, read_messages(spark, args), args)
+    mongo_uri, mongo_db, mongo_collection = args.mongo_uri, args.mongo_db, args.mongo_collection
+    mongo_batch_size, mongo_write_concern = args.mongo_batch_size, args.mongo_write_concern
+
+    def write_batch(batch_df, batch_id):
+        # Runs on the driver; each partition is scored and bulk-written on its executor
+        batch_df.foreachPartition(lambda rows: write_partition_to_mongo(
+            rows, mongo_uri, mongo_db, mongo_collection, batch_size=mongo_batch_size, write_concern=mongo_write_concern
+        ))
+
+    # Offsets are committed to the checkpoint only after foreachBatch succeeds, so a failed batch is replayed
+    query = scored.writeStream \
+        .queryName('sentiment-scoring') \
+        .foreachBatch(write_batch) \
+        .option('checkpointLocation', args.checkpoint_dir) \
+        .trigger(processingTime=f'{args.trigger_interval_s} seconds') \
+        .start()
+    signal.signal(signal.SIGTERM, lambda *_: query.stop())
+    print(f"Streaming {args.kafka_topic} into {mongo_db}.{mongo_collection} (checkpoints in {args.checkpoint_dir})...")
+    try:
+        while query.isActive:
+            query.awaitTermination(args.progress_interval_s)
+            progress = query.lastProgress
+            if progress:
+                print(
+                    f"batch {progress['batchId']}: {progress['numInputRows']} rows, "
+                    f"{progress.get('processedRowsPerSecond', 0.0):.1f} rows/s"
+                )
+    except KeyboardInterrupt:
+        print("Stopping streaming query...")
+        query.stop()
+    finally:
+        spark.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score the Kafka topic with Spark Structured Streaming and write results to MongoDB")
+    parser.add_argument('--kafka-bootstrap-servers', default='localhost:9092', help="comma-separated host:port list")
+    parser.add_argument('--kafka-topic', default='text_analysis')
+    parser.add_argument('--starting-offsets', default='latest', choices=['latest', 'earliest'], help="only used when the checkpoint is new")
+    parser.add_argument('--max-offsets-per-trigger', type=int, default=None, help="cap on records per micro-batch")
+    parser.add_argument('--min-partitions', type=int, default=None)
+    parser.add_argument('--kafka-package', default=KAFKA_PACKAGE, help="Spark Kafka connector to fetch; empty if it is already on the classpath")
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+    parser.add_argument('--mongo-db', default='sentiment_analysis')
+    parser.add_argument('--mongo-collection', default='results')
+    parser.add_argument('--mongo-batch-size', type=int, default=500)
+    parser.add_argument('--mongo-write-concern', type=int, default=1)
+    parser.add_argument('--bundle-dir', default=DEFAULT_BUNDLE_DIR)
+    parser.add_argument('--bundle-version', default=None, help="default: the bundle's LATEST version")
+    parser.add_argument('--backend', default='numpy', choices=['numpy', 'tflite', 'keras'], help="numpy needs no TensorFlow on the executors")
+    parser.add_argument('--cascade', action='store_true', help="answer confident texts with the bundle's first-stage classifier, if it has one")
+    parser.add_argument('--udf-batch-size', type=int, default=2048, help="rows per pandas UDF call, i.e. per forward pass")
+    parser.add_argument('--checkpoint-dir', default='stream_checkpoints')
+    parser.add_argument('--trigger-interval-s', type=int, default=5)
+    parser.add_argument('--progress-interval-s', type=int, default=30)
+    parser.add_argument('--download-nltk', action='store_true')
+    run(parser.parse_args())
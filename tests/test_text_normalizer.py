@@ -0,0 +1,120 @@
+import random
+
+import pytest
+
+import mainCodeDLAndSparkAndPipline as pipeline
+
+# Small stand-ins for the NLTK corpora, so the tests run offline
+STOP_WORDS = frozenset(['i', 'a', 'an', 'the', 'is', 'it', 'this', 'and', 'so', 'to', 'of', 'on', 'my', 'you', 'are', 'in', 'be', 'not'])
+
+HAND_WRITTEN_CORPUS = [
+    "I love this product!",
+    "I hate this movie.",
+    "It's okay, nothing special.",
+    "This is the worst customer service experience ever! #badservice",
+    "Totally recommend this laptop, it's the best investment! #bestpurchase",
+    "I am so happy today! 😁😊",
+    "This place is terrible 😡👎",
+    "IMHO u should check https://www.reddit.com/r/rust BTW, lol",
+    "WTF is going on?? IDC anymore... brb",
+    "<p>Running <b>tests</b> all day</p> and they were failing",
+    "wwwhat a weird http token",
+    "   spaced\tout\nlines   ",
+    "",
+    None,
+]
+
+class FakeLemmatizer:
+    """Suffix-stripping stand-in for WordNetLemmatizer"""
+    def lemmatize(self, word, pos='n'):
+        for suffix in ('ing', 'ed', 's'):
+            if len(word) > len(suffix) + 2 and word.endswith(suffix):
+                return word[:-len(suffix)]
+        return word
+
+def synthetic_corpus(size=500, seed=0):
+    """Texts mixing the token kinds each cleaning stage handles"""
+    rng = random.Random(seed)
+    tokens = [
+        'Running', 'played', 'cats', 'GOOD', 'bad', 'Modi', 'election', 'jobs', 'is', 'The', 'not', 'You',
+        'u', 'LOL', 'imho', 'Gn', 'WTF', 'ily', 'B4', 'TTYL',
+        'https://example.com/a?b=1', 'www.example.org', 'see:http://x.y', 'wwwhat', 'http',
+        '😁', '👎🏽', 'café', 'naïve', 'I❤️U',
+        "it's", 'well...', '#hashtag', '@user', '100%', '--', '!!!', '(yes)', "don't",
+        '<b>bold</b>', '<a href="http://x">link</a>', '<br/>', '<3', 'a>b',
+    ]
+    separators = [' ', ' ', ' ', '  ', '\t', '\n', ', ', '. ']
+    texts = []
+    for _ in range(size):
+        parts = []
+        for _ in range(rng.randint(0, 15)):
+            parts.append(rng.choice(tokens))
+            parts.append(rng.choice(separators))
+        texts.append(''.join(parts))
+    return texts
+
+@pytest.fixture
+def classifier(monkeypatch):
+    monkeypatch.setattr(pipeline, 'get_stop_words', lambda: STOP_WORDS)
+    monkeypatch.setattr(pipeline.lazy_import('nltk.stem'), 'WordNetLemmatizer', FakeLemmatizer)
+    return pipeline.RedditSentimentClassifier(max_words=100, max_len=10, embedding_dim=8)
+
+def assert_equivalent(classifier, texts):
+    mismatches = [
+        (text, classifier.clean_text_stepwise(text), classifier.clean_text(text))
+        for text in texts
+        if classifier.clean_text_stepwise(text) != classifier.clean_text(text)
+    ]
+    assert not mismatches, f"{len(mismatches)}/{len(texts)} texts differ, first: {mismatches[0]}"
+
+def test_stubs_are_used(classifier):
+    assert classifier.normalizer.stop_words == STOP_WORDS
+    assert isinstance(classifier.normalizer.lemmatizer, FakeLemmatizer)
+    assert classifier.clean_text("The cats are Running") == 'cat runn'
+
+def test_hand_written_corpus(classifier):
+    assert_equivalent(classifier, HAND_WRITTEN_CORPUS)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_synthetic_corpus(classifier, seed):
+    assert_equivalent(classifier, synthetic_corpus(seed=seed))
+
+def test_without_lemmatizer(classifier):
+    classifier.wordnet_lemmatizer = None
+    classifier.normalizer = pipeline.TextNormalizer(None)
+    assert_equivalent(classifier, HAND_WRITTEN_CORPUS + synthetic_corpus(seed=3))
+
+def test_non_string_input(classifier):
+    for value in (None, float('nan'), 42):
+        assert classifier.clean_text(value) == classifier.clean_text_stepwise(value) == ''
+
+def test_settings_report_the_stages_in_use(classifier):
+    assert classifier.normalizer.settings() == {'stopwords': True, 'lemmatizer': True}
+    assert pipeline.TextNormalizer(None).settings()['lemmatizer'] is False
+
+def test_missing_corpora_stop_training(monkeypatch):
+    def find(resource):
+        raise LookupError(resource)
+    monkeypatch.setattr(pipeline.lazy_import('nltk').data, 'find', find)
+    assert pipeline.ensure_nltk_resources() is False
+    with pytest.raises(RuntimeError, match='--download-nltk'):
+        pipeline.ensure_nltk_resources(required=True)
+
+def test_missing_texts_are_not_hashed():
+    assert pipeline.raw_text_key(None) is None
+    assert pipeline.raw_text_key(float('nan')) is None
+    assert pipeline.raw_text_key('None') != pipeline.raw_text_key('nan')
+
+def test_cache_key_follows_normalizer_settings(classifier):
+    degraded = pipeline.TextNormalizer(None)
+    degraded.stop_words = frozenset()
+    assert classifier.normalizer.cache_key() == pipeline.TextNormalizer(FakeLemmatizer()).cache_key()
+    assert classifier.normalizer.cache_key() != degraded.cache_key()
+
+def test_clean_text_cache(classifier, tmp_path):
+    texts = ["The cats are Running", None, 'None', float('nan'), "The cats are Running"]
+    expected = [classifier.clean_text(text) for text in texts]
+    assert pipeline.CleanTextCache(str(tmp_path), classifier.normalizer).clean(texts, num_workers=1) == expected
+    cache = pipeline.CleanTextCache(str(tmp_path), classifier.normalizer)
+    assert len(cache.entries) == 2
+    assert cache.clean(texts, num_workers=1) == expected